@@ -1,8 +1,17 @@
-import numpy as np
-from scipy.integrate import quad
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
 
-import matplotlib.pyplot as plt
 import numpy as np
+# scipy and matplotlib are imported where used, to keep importing this module fast
+
+logger = logging.getLogger(__name__)
 
 ### metric conversion constants ###
 LB_TO_KG = 0.45359237
@@ -38,6 +47,185 @@ def dist_units_str(d):
 def t_round_str(t):
   return str(round(t, 2)) + " s"
 
+### opt-in instrumentation ###
+class Stats():
+  '''
+  Counters for Train/TrainProfile hot paths, collected only while enabled:
+  calls = calls per method
+  wall_time = cumulative wall time (s) per method, including time in nested calls
+  quad_evals = integrand evaluations by quadrature (calc_accel_dist, method="reference")
+  segments = stop-to-stop segments calculated
+  dist_limited_segments = segments too short to reach v_max_mph
+  segment_iterations = total peak-speed solver iterations spent on those segments
+  max_iterations = most solver iterations spent on a single solve
+  '''
+  def __init__(self):
+    self.enabled = False
+    self.reset()
+
+  def reset(self):
+    self.calls = {}
+    self.wall_time = {}
+    self.quad_evals = 0
+    self.segments = 0
+    self.dist_limited_segments = 0
+    self.segment_iterations = 0
+    self.max_iterations = 0
+
+  def record_segments(self, segments, dist_limited_segments, iterations):
+    '''Records one stop-to-stop calculation; a batch solve spends iterations on each dist-limited segment'''
+    self.segments += segments
+    self.dist_limited_segments += dist_limited_segments
+    self.segment_iterations += iterations * dist_limited_segments
+    self.max_iterations = max(self.max_iterations, iterations)
+
+  def merge(self, stats_dict):
+    '''Adds in the counters of another Stats, as returned by to_dict (eg. from a worker process)'''
+    for name, n in stats_dict["calls"].items():
+      self.calls[name] = self.calls.get(name, 0) + n
+    for name, t in stats_dict["wall_time"].items():
+      self.wall_time[name] = self.wall_time.get(name, 0) + t
+    self.quad_evals += stats_dict["quad_evals"]
+    self.segments += stats_dict["segments"]
+    self.dist_limited_segments += stats_dict["dist_limited_segments"]
+    self.segment_iterations += stats_dict["segment_iterations"]
+    self.max_iterations = max(self.max_iterations, stats_dict["max_iterations"])
+
+  def to_dict(self):
+    return {"calls": dict(self.calls),
+            "wall_time": dict(self.wall_time),
+            "quad_evals": self.quad_evals,
+            "segments": self.segments,
+            "dist_limited_segments": self.dist_limited_segments,
+            "segment_iterations": self.segment_iterations,
+            "max_iterations": self.max_iterations}
+
+  def to_json(self, path):
+    with open(path, "w") as f:
+      json.dump(self.to_dict(), f, indent=2)
+
+STATS = Stats()
+
+def enable_stats(enabled=True, reset=True):
+  '''Turns instrumentation (STATS) on or off; optionally clears its counters'''
+  STATS.enabled = enabled
+  if reset:
+    STATS.reset()
+
+def _instrumented(method):
+  '''Decorator: counts calls and wall time of method in STATS, while enabled'''
+  name = method.__qualname__
+  @functools.wraps(method)
+  def wrapper(*args, **kwargs):
+    if not STATS.enabled:
+      return method(*args, **kwargs)
+    t_start = time.perf_counter()
+    try:
+      return method(*args, **kwargs)
+    finally:
+      STATS.calls[name] = STATS.calls.get(name, 0) + 1
+      STATS.wall_time[name] = STATS.wall_time.get(name, 0) + time.perf_counter() - t_start
+  return wrapper
+
+class Memo():
+  '''
+  Per-Train LRU memo of calculation results, opt-in (see Train.enable_memo)
+  Args are snapped to multiples of their quantum before calculating, so nearby args
+  share one entry; results are exact for the snapped args
+  '''
+  def __init__(self, d_quantum_mi=0.001, v_quantum_mph=0.1, t_quantum_s=0.001, maxsize=65536):
+    '''
+    d_quantum_mi, v_quantum_mph, t_quantum_s = quantum of distance (mi), speed (mph), time (s) args
+    maxsize = max number of results kept, least recently used evicted first
+    '''
+    assert all([d_quantum_mi > 0, v_quantum_mph > 0, t_quantum_s > 0, maxsize > 0]), \
+      "The following args must be positive: d_quantum_mi, v_quantum_mph, t_quantum_s, maxsize"
+    self.quanta = {"d": d_quantum_mi, "v": v_quantum_mph, "t": t_quantum_s}
+    self.maxsize = maxsize
+    # set while a memoized calculation runs, so its own inner calls are not snapped
+    self._local = threading.local()
+    self.clear()
+
+  def clear(self):
+    self.results = OrderedDict()
+    self.hits = {}
+    self.misses = {}
+    self.evictions = 0
+
+  @property
+  def busy(self):
+    return getattr(self._local, "busy", False)
+
+  def steps(self, kind, x):
+    '''Returns x in whole quanta of kind ("d", "v" or "t"), elementwise; nonzero x stays nonzero'''
+    x = np.asarray(x, dtype=float)
+    steps = np.rint(x / self.quanta[kind])
+    steps = np.where(x != 0, np.sign(x) * np.maximum(np.abs(steps), 1), 0).astype(np.int64)
+    return steps if steps.ndim else int(steps)
+
+  def snap(self, kind, steps):
+    '''Returns the arg value of steps quanta of kind'''
+    return steps * self.quanta[kind]
+
+  def get(self, name, key):
+    '''Returns the memoized result of method name for key, or None (counted as a hit or miss)'''
+    res = self.results.get((name, key))
+    if res is None:
+      self.misses[name] = self.misses.get(name, 0) + 1
+    else:
+      self.hits[name] = self.hits.get(name, 0) + 1
+      self.results.move_to_end((name, key))
+    return res
+
+  def put(self, name, key, res):
+    self.results[(name, key)] = res
+    while len(self.results) > self.maxsize:
+      self.results.popitem(last=False)
+      self.evictions += 1
+
+  def to_dict(self):
+    return {"hits": dict(self.hits),
+            "misses": dict(self.misses),
+            "evictions": self.evictions,
+            "size": len(self.results),
+            "maxsize": self.maxsize}
+
+def _call_busy(memo, method, *args, **kwargs):
+  '''Calls method with memo marked busy, so its inner memoized calls are calculated exactly'''
+  memo._local.busy = True
+  try:
+    return method(*args, **kwargs)
+  finally:
+    memo._local.busy = False
+
+def _memoized(*kinds):
+  '''
+  Decorator: while the Train's memo is enabled, calls with scalar leading args are
+  answered from the memo, keyed on those args snapped per kinds (one of "d", "v", "t"
+  per leading arg) and the remaining args; calls with array args or diagnostics are not,
+  and are calculated exactly throughout
+  '''
+  def decorator(method):
+    name = method.__name__
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+      memo = self.memo
+      if memo is None or memo.busy:
+        return method(self, *args, **kwargs)
+      # bypassed calls are exact, and so are their inner calls: they run busy too
+      if kwargs.get("diagnostics") or len(args) < len(kinds) or any(np.ndim(x) for x in args[:len(kinds)]):
+        return _call_busy(memo, method, self, *args, **kwargs)
+      steps = tuple(memo.steps(kind, x) for kind, x in zip(kinds, args))
+      key = (steps, args[len(kinds):], tuple(sorted(kwargs.items())))
+      res = memo.get(name, key)
+      if res is None:
+        snapped = tuple(memo.snap(kind, n) for kind, n in zip(kinds, steps))
+        res = _call_busy(memo, method, self, *snapped, *args[len(kinds):], **kwargs)
+        memo.put(name, key, res)
+      return res
+    return wrapper
+  return decorator
+
 ### helpers ###
 def calc_D(h_in, w_in, rho=1.2041, C_d=1):
   '''
@@ -59,6 +247,28 @@ def calc_D(h_in, w_in, rho=1.2041, C_d=1):
   D_final = 0.5 * h * w * rho * C_d
   return D_final
 
+def _scalar_or_array(x):
+  '''Returns x as a float if it is 0-dimensional, else as an array'''
+  if np.ndim(x) == 0:
+    return float(x)
+  return x
+
+def _run_min_accumulate(x, run_len):
+  '''
+  Returns the running minimum of x, restarted at each run: x is run after run, of run_len elements each
+  Runs are padded into matrices of runs of similar length (bucketed by powers of 2), so the cost is linear in len(x)
+  '''
+  res = np.empty_like(x)
+  starts = np.cumsum(run_len) - run_len
+  bucket = np.ceil(np.log2(run_len)).astype(int)
+  for b in np.unique(bucket):
+    runs = np.flatnonzero(bucket == b)
+    col = np.arange(2**b)
+    inside = col[None, :] < run_len[runs, None]
+    idx = np.where(inside, starts[runs, None] + col[None, :], 0)
+    res[idx[inside]] = np.minimum.accumulate(np.where(inside, x[idx], np.inf), axis=1)[inside]
+  return res
+
 def calc_avg_vel(d, t):
   '''Returns v_avg given any distance and time'''
   assert all([d > 0, t > 0]), \
@@ -68,7 +278,256 @@ def calc_avg_vel(d, t):
   return d / t
 
 
-class Train():
+class _TrainCurves():
+  # acceleration and braking curves, vectorized: shared by Train (scalar params)
+  # and TrainBatch (per-consist param arrays), which set m, P, F, D, brake_*, v_1 and t_1
+
+  # opt-in result memo (Train.enable_memo), read by the memoized calc_* methods
+  memo = None
+
+  @_instrumented
+  @_memoized("v")
+  def calc_accel_time(self, v_mph):
+    '''
+    Returns the time required to reach v_mph (mph => m/s), -1 if unable
+    v_mph may be a scalar or an array; returns time in the same shape
+    '''
+    v_mph = np.asarray(v_mph, dtype=float)
+    assert np.all(v_mph >= 0), \
+      "The following args must be nonnegative: v_mph"
+    v = v_mph * MPH_TO_M_S
+
+    # implements equation 1.2.2
+    t_lin = self.m * v / self.F
+    # implements equation 1.3.2
+    numer = self.m * (v**2 - (self.v_1 ** 2))
+    denom = 2 * (self.P - (self.D * v**3))
+    with np.errstate(divide="ignore", invalid="ignore"):
+      t_pow = np.where(denom > 0, (numer / denom) + self.t_1, -1)
+
+    t_final = np.where(v <= self.v_1, t_lin, t_pow)
+    return _scalar_or_array(t_final)
+
+  @_instrumented
+  def calc_accel_vel(self, t):
+    '''
+    Returns the v (m/s) after t (s) of acceleration
+    by solving for v in equation of form av^3 + bv^2 + c = 0
+    t may be a scalar or an array of times (s); returns v in the same shape
+    '''
+    t = np.asarray(t, dtype=float)
+    assert np.all(t >= 0), \
+      "The following args must be nonnegative: t"
+
+    # implements equation 1.2.1
+    vel_lin = self.F * t / self.m
+
+    # implements equation 1.3.3
+    # t is clamped to t_1 so the power branch stays defined where it is not used
+    t_pow = np.maximum(t, self.t_1)
+    a = 2 * self.D * (t_pow - self.t_1)
+    b = self.m
+    c = (2 * self.P * (self.t_1 - t_pow)) - (self.m * (self.v_1 ** 2))
+    # substituting u = 1/v gives the depressed cubic (-c)u^3 - bu - a = 0,
+    # whose largest real root is the only positive one;
+    # closed-form (trigonometric/hyperbolic Cardano) real root, no eigenvalue solve
+    r = 2 * np.sqrt(b / (-3 * c))
+    arg = (1.5 * a / b) * np.sqrt(-3 * c / b)
+    u = np.where(arg <= 1,
+                 r * np.cos(np.arccos(np.minimum(arg, 1)) / 3),
+                 r * np.cosh(np.arccosh(np.maximum(arg, 1)) / 3))
+    vel_pow = 1 / u
+
+    vel_final = np.where(t < self.t_1, vel_lin, vel_pow)
+    return _scalar_or_array(vel_final)
+
+  @_instrumented
+  @_memoized("t")
+  def calc_accel_dist(self, t, method="analytic"):
+    '''
+    Returns the dist (m) traveled after t (s) of acceleration
+    t may be a scalar or an array of times (s); returns dist in the same shape
+    method = "analytic": integrates over v instead of t, in closed form
+    method = "reference": integrates v(t)dt over [0, t] with adaptive quadrature
+    '''
+    assert method in ("analytic", "reference"), \
+      "method must be one of: 'analytic', 'reference'"
+    t = np.asarray(t, dtype=float)
+    assert np.all(t > 0), \
+      "The following args must be positive: t"
+
+    if method == "reference":
+      d_final = np.vectorize(self._calc_accel_dist_quad, otypes=[float])(t)
+    else:
+      d_final = self._calc_accel_dist_vel(self.calc_accel_vel(t))
+    return d_final
+
+  def _calc_accel_dist_quad(self, t):
+    '''Returns the dist (m) traveled after t (s) of acceleration, by quad over [0, t]'''
+    from scipy.integrate import quad
+    # implements equation 1.3.4
+    res, err, info = quad(self.calc_accel_vel, 0, t, full_output=1)[0:3]
+    if STATS.enabled:
+      STATS.quad_evals += info["neval"]
+    # ensure integral calculation is accurate
+    assert err < res * 0.01, f"Distance calculated with high error +-{err}%"
+    return res
+
+  def _calc_accel_dist_vel(self, v):
+    '''
+    Returns the dist (m) traveled accelerating from a stop up to v (m/s), in closed form
+    v may be a scalar or an array; returns dist in the same shape
+    '''
+    v = np.asarray(v, dtype=float)
+
+    # below v_1: integrates equation 1.2.1, d = m * v^2 / 2F
+    d_lin = 0.5 * self.m * (np.minimum(v, self.v_1) ** 2) / self.F
+
+    # above v_1: integrates v dt over [t_1, t(v)] by parts, with t(v) from equation 1.3.2
+    # d = v * (t(v) - t_1) - (m/2) * integral of (w^2 - v_1^2) / (P - D*w^3) dw over [v_1, v]
+    v_hi = np.maximum(v, self.v_1)
+    # D may be an array (TrainBatch): both forms are evaluated, drag-free consists
+    # take D = 1 in the drag form and then discard it
+    has_drag = np.asarray(self.D) > 0
+    D = np.where(has_drag, self.D, 1.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+      # integral of w^2 / (P - D*w^3) is -ln(P - D*w^3) / 3D
+      int_sq_drag = -np.log1p(-D * (v_hi**3 - self.v_1**3) / (self.P - D * self.v_1**3)) / (3 * D)
+      # integral of 1 / (P - D*w^3) by partial fractions, with c^3 = P/D
+      c = np.cbrt(self.P / D)
+      def G(w):
+        return (np.log((w**2 + c*w + c**2) / (c - w)**2) \
+          + 2 * np.sqrt(3) * np.arctan((2*w + c) / (c * np.sqrt(3)))) / (6 * c**2)
+      int_one_drag = (G(v_hi) - G(self.v_1)) / D
+    # D = 0: polynomial integrals
+    int_sq = np.where(has_drag, int_sq_drag, (v_hi**3 - self.v_1**3) / (3 * self.P))
+    int_one = np.where(has_drag, int_one_drag, (v_hi - self.v_1) / self.P)
+    d_pow = 0.5 * self.m * (v_hi * (v_hi**2 - self.v_1**2) / (self.P - self.D * v_hi**3) \
+      - int_sq + (self.v_1**2) * int_one)
+
+    d_final = d_lin + d_pow
+    return _scalar_or_array(d_final)
+
+  @_instrumented
+  def calc_brake_time(self, v_mph):
+    '''
+    Returns the time (s) required to brake to a stop from v_mph (mph => m/s)
+    v_mph may be a scalar or an array; returns time in the same shape
+    '''
+    v_mph = np.asarray(v_mph, dtype=float)
+    assert np.all(v_mph >= 0), \
+      "The following args must be nonnegative: v_mph"
+    
+    # implements equation 2.1.1
+    v = v_mph * MPH_TO_M_S
+    t_final = np.where(v < self.brake_v1,
+                       v * (1 / self.brake_a1),
+                       (v - self.brake_v1) * (1 / self.brake_a2) + self.brake_v1 * (1 / self.brake_a1))
+    return _scalar_or_array(t_final)
+
+  @_instrumented
+  def calc_brake_vel(self, t, v_mph):
+    '''
+    Returns the velocity (m/s) after t (s) of braking from v_mph (mph => m/s)
+    t, v_mph may be scalars or (broadcastable) arrays; returns velocity in the broadcast shape
+    '''
+    t = np.asarray(t, dtype=float)
+    v_mph = np.asarray(v_mph, dtype=float)
+    assert all([np.all(t >= 0), np.all(v_mph >= 0)]), \
+      "The following args must be nonnegative: t, v_mph"
+
+    v = v_mph * MPH_TO_M_S
+
+    # implements equation 2.1.3
+    vel_low = np.maximum(0, v - self.brake_a1 * t)
+    # implements equation 2.1.4
+    t_1 = (v - self.brake_v1) / self.brake_a2
+    vel_high = np.where(t < t_1,
+                        v - (self.brake_a2 * t),
+                        np.maximum(0, self.brake_v1 - (self.brake_a1 * (t - t_1))))
+
+    vel_final = np.where(v < self.brake_v1, vel_low, vel_high)
+    return _scalar_or_array(vel_final)
+  
+  @_instrumented
+  def calc_brake_dist(self, v_mph):
+    '''
+    Returns the dist (m) required to brake to a stop from v_mph (mph => m/s)
+    v_mph may be a scalar or an array; returns dist in the same shape
+    '''
+    v_mph = np.asarray(v_mph, dtype=float)
+    assert np.all(v_mph >= 0), \
+      "The following args must be nonnegative: v_mph"
+    v = v_mph * MPH_TO_M_S
+
+    # implements equation 2.1.2
+    d_low = 0.5 * (v ** 2) / self.brake_a1
+    add1 = self.brake_v1 * (v - self.brake_v1) * (1 / self.brake_a2)
+    add2 = 0.5 * ((v - self.brake_v1) ** 2) / self.brake_a2
+    add3 = 0.5 * (self.brake_v1 ** 2) / self.brake_a1
+    d_final = np.where(v < self.brake_v1, d_low, add1 + add2 + add3)
+    return _scalar_or_array(d_final)
+
+  def _calc_accel_dist_slope(self, v):
+    '''Returns d/dv of the accel dist up to v (m/s), elementwise'''
+    v = np.asarray(v, dtype=float)
+    # v * dt/dv, with t(v) from equations 1.2.2, 1.3.2
+    denom = self.P - (self.D * v**3)
+    with np.errstate(divide="ignore", invalid="ignore"):
+      dt_dv_pow = self.m * (v * denom + 1.5 * self.D * v**2 * (v**2 - self.v_1**2)) / (denom ** 2)
+    return v * np.where(v <= self.v_1, self.m / self.F, dt_dv_pow)
+
+  def _calc_brake_dist_slope(self, v):
+    '''Returns d/dv of the brake dist from v (m/s), elementwise'''
+    v = np.asarray(v, dtype=float)
+    # v / (deceleration rate), from equation 2.1.2
+    return v / np.where(v < self.brake_v1, self.brake_a1, self.brake_a2)
+
+  def _calc_brake_vel_dist(self, d):
+    '''Returns the v (m/s) from which braking to a stop takes d (m), elementwise (inverts equation 2.1.2)'''
+    d = np.asarray(d, dtype=float)
+    d_v1 = 0.5 * (self.brake_v1 ** 2) / self.brake_a1
+    v_low = np.sqrt(2 * self.brake_a1 * np.minimum(d, d_v1))
+    v_high = np.sqrt(self.brake_v1 ** 2 + 2 * self.brake_a2 * np.maximum(d - d_v1, 0))
+    return np.where(d < d_v1, v_low, v_high)
+
+  def _solve_dist_vel(self, d_target, v_hi, v_tol, v_lo=0, accel=True, brake=True):
+    '''
+    Returns (v, iterations): v (m/s) on [v_lo, v_hi] where the accel dist up to v (if accel)
+    plus the brake dist from v (if brake) equals d_target (m), elementwise, to within v_tol (m/s)
+    The lhs is increasing and convex in v, so Newton's method started from v_hi
+    converges from above without overshooting; steps that would leave the bracket
+    (only possible from roundoff) fall back to bisection
+    '''
+    d_target, lo, hi = np.broadcast_arrays(np.asarray(d_target, dtype=float),
+                                           np.asarray(v_lo, dtype=float),
+                                           np.asarray(v_hi, dtype=float))
+    lo = lo.copy()
+    hi = hi.copy()
+    v = hi.copy()
+    iterations = 0
+    while True:
+      iterations += 1
+      err = -d_target
+      slope = 0
+      if accel:
+        err = err + self._calc_accel_dist_vel(v)
+        slope = slope + self._calc_accel_dist_slope(v)
+      if brake:
+        err = err + self.calc_brake_dist(v / MPH_TO_M_S)
+        slope = slope + self._calc_brake_dist_slope(v)
+      lo = np.where(err < 0, v, lo)
+      hi = np.where(err > 0, v, hi)
+      with np.errstate(divide="ignore", invalid="ignore"):
+        v_next = v - err / slope
+      v_next = np.where((v_next >= lo) & (v_next <= hi), v_next, 0.5 * (lo + hi))
+      v_next = np.where(err == 0, v, v_next)
+      converged = np.all(np.abs(v_next - v) < v_tol)
+      v = v_next
+      if converged:
+        return v, iterations
+
+class Train(_TrainCurves):
   def __init__(self,
                m_lb,
                P_hp,
@@ -103,9 +562,10 @@ class Train():
     self.brake_v1 = brake_v1_mph * MPH_TO_M_S
     
     self.D = D
-    print(f"Initializing train with weight {mass_units_str(self.m)}, power {power_units_str(self.P)}, tractive force {force_units_str(self.F)}")
-    print(f"And braking performance: BRAKE_A1 {vel_units_str(self.brake_a1)} (mphps), BRAKE_A2 {vel_units_str(self.brake_a2)} (mphps), BRAKE_V1 {vel_units_str(self.brake_v1)}")
-    print(f"And combined coefficient of drag {self.D}")
+    if logger.isEnabledFor(logging.INFO):
+      logger.info(f"Initializing train with weight {mass_units_str(self.m)}, power {power_units_str(self.P)}, tractive force {force_units_str(self.F)}")
+      logger.info(f"And braking performance: BRAKE_A1 {vel_units_str(self.brake_a1)} (mphps), BRAKE_A2 {vel_units_str(self.brake_a2)} (mphps), BRAKE_V1 {vel_units_str(self.brake_v1)}")
+      logger.info(f"And combined coefficient of drag {self.D}")
     self.calc_power_limit()
 
   def calc_power_limit(self):
@@ -117,169 +577,339 @@ class Train():
     self.v_1 = self.P/self.F
     # implements equation 1.1.2
     self.t_1 = self.m * self.P / (self.F**2)
-    print(f"Traction limited by power above {vel_units_str(self.v_1)}, after {t_round_str(self.t_1)}")
-
-  def calc_accel_time(self, v_mph):
-    '''Returns the time required to reach v_mph (mph => m/s), -1 if unable'''
-    assert v_mph >= 0, \
-      "The following args must be nonnegative: v_mph"
-    v = v_mph * MPH_TO_M_S
-
-    if v <= self.v_1:
-      # implements equation 1.2.2
-      t_final = self.m * v / self.F
-    else:
-      # implements equation 1.3.2
-      numer = self.m * (v**2 - (self.v_1 ** 2))
-      denom = 2 * (self.P - (self.D * v**3))
-      if denom < 0:
-        return -1
-      t_final = (numer / denom) + self.t_1
-    return t_final
+    if logger.isEnabledFor(logging.INFO):
+      logger.info(f"Traction limited by power above {vel_units_str(self.v_1)}, after {t_round_str(self.t_1)}")
 
-  def calc_accel_vel(self, t):
+  def enable_memo(self, d_quantum_mi=0.001, v_quantum_mph=0.1, t_quantum_s=0.001, maxsize=65536):
     '''
-    Returns the v (m/s) after t (s) of acceleration
-    by solving for v in equation of form av^3 + bv^2 + c = 0
+    Turns on memoization of stop_to_stop_time(s), calc_accel_dist and calc_accel_time:
+    repeated args, snapped to multiples of d_quantum_mi, v_quantum_mph, t_quantum_s
+    (see Memo), are answered from memory, up to maxsize results
+    Returns the Memo, whose hits/misses count lookups per method
     '''
-    assert t >= 0, \
-      "The following args must be nonnegative: t"
+    self.memo = Memo(d_quantum_mi, v_quantum_mph, t_quantum_s, maxsize)
+    return self.memo
 
-    if t < self.t_1:
-      # implements equation 1.2.1
-      vel_final = self.F * t / self.m
-    else:
-      # implements equation 1.3.3
-      a = 2 * self.D * (t - self.t_1)
-      b = self.m
-      c = (2 * self.P * (self.t_1 - t)) - (self.m * (self.v_1 ** 2))
-      p = [a, b, 0, c]
-      roots = np.roots(p)
-      # required to extract real solution
-      vel_final = abs(roots[-1])
-    return vel_final
+  def disable_memo(self):
+    self.memo = None
 
-  def calc_accel_dist(self, t):
-    '''
-    Returns the dist (m) traveled after t (s) of acceleration
-    by integrating v(t)dt over [0, t]
-    '''
-    assert t > 0, \
-      "The following args must be positive: t"
-
-    # implements equation 1.3.4
-    res, err = quad(self.calc_accel_vel, 0, t)
-    # ensure integral calculation is accurate
-    assert err < res * 0.01, f"Distance calculated with high error +-{err}%"
-    return res
-
-  def calc_brake_time(self, v_mph):
-    '''Returns the time (s) required to brake to a stop from v_mph (mph => m/s)'''
-    assert v_mph >= 0, \
-      "The following args must be nonnegative: v_mph"
-    
-    # implements equation 2.1.1
-    v = v_mph * MPH_TO_M_S
-    if v < self.brake_v1:
-      t_final = v * (1 / self.brake_a1)
-    else:
-      t_final = (v - self.brake_v1) * (1 / self.brake_a2) + self.brake_v1 * (1 / self.brake_a1)
-    return t_final
-
-  def calc_brake_vel(self, t, v_mph):
-    '''Returns the velocity (m/s) after t (s) of braking from v_mph (mph => m/s)'''
-    assert all([t >= 0, v_mph >= 0]), \
-      "The following args must be nonnegative: t, v_mph"
-
-    v = v_mph * MPH_TO_M_S
-    
-    if v < self.brake_v1:
-      # implements equation 2.1.3
-      vel_final = max(0, v - self.brake_a1 * t)
-    else:
-      # implements equation 2.1.4
-      t_1 = (v - self.brake_v1) / self.brake_a2
-      
-      if t < t_1:
-        vel_final = v - (self.brake_a2 * t)
-      else:
-        vel_final = max(0, self.brake_v1 - (self.brake_a1 * (t - t_1))) 
-
-    return vel_final
-  
-  def calc_brake_dist(self, v_mph):
-    '''Returns the dist (m) required to brake to a stop from v_mph (mph => m/s)'''
-    assert v_mph >= 0, \
-      "The following args must be nonnegative: v_mph"
-    v = v_mph * MPH_TO_M_S
-
-    # implements equation 2.1.2
-    if v < self.brake_v1:
-      d_final = 0.5 * (v ** 2) / self.brake_a1
-    else:
-      add1 = self.brake_v1 * (v - self.brake_v1) * (1 / self.brake_a2)
-      add2 = 0.5 * ((v - self.brake_v1) ** 2) / self.brake_a2
-      add3 = 0.5 * (self.brake_v1 ** 2) / self.brake_a1
-      d_final = add1 + add2 + add3
-    return d_final
-
-  def stop_to_stop_time(self, d_tot_mi, v_max_mph, t_dwell=120):
+  @_instrumented
+  @_memoized("d", "v")
+  def stop_to_stop_time(self, d_tot_mi, v_max_mph, t_dwell=120, v_tol_mph=1e-6, diagnostics=False):
     '''
     Returns the total arrival-to-arrival travel time (s) from one stop to the next
     Returns -1 if travel time cannot be calculated
     d_mi = track distance between the two stops (mi => m)
     vmax_mph = practical top track speed (mph => m/s)
     t_dwell (optional) = dwell/buffer time at first stop (s)
+    v_tol_mph (optional) = tolerance on the peak speed (mph), if distance does not allow reaching vmax_mph
+    diagnostics (optional) = if True, returns (time, info) where info is a dict with:
+      v_peak_mph = achieved peak speed (mph)
+      dist_limited = True if d_mi is too short to reach vmax_mph
+      t_acc, t_vmax, t_brake = time (s) spent accelerating, at peak speed, braking
+      d_acc, d_vmax, d_brake = dist (m) covered accelerating, at peak speed, braking
+      iterations = root-finder iterations spent solving for the peak speed
     '''
     assert all([d_tot_mi > 0, v_max_mph > 0]), \
       "The following args must be positive: d_tot_mi, v_max_mph"
     assert t_dwell >= 0, \
       "The following args must be nonnegative: t_dwell"
+    assert v_tol_mph > 0, \
+      "The following args must be positive: v_tol_mph"
     
-    v_max = v_max_mph * MPH_TO_M_S
     d_tot = d_tot_mi * MI_TO_M
 
     t_acc = self.calc_accel_time(v_max_mph)
     # v_max_mph error case
     if t_acc == -1:
-        print("Error: v_max_mph is unrealistic; speed is not reachable! Travel time cannot be calculated! Check params and their units!")
-        return -1
-    d_acc = self.calc_accel_dist(t_acc)
-    t_brake = self.calc_brake_time(v_max_mph)
+        logger.error("v_max_mph is unrealistic; speed is not reachable! Travel time cannot be calculated! Check params and their units!")
+        return (-1, None) if diagnostics else -1
+    d_acc = self._calc_accel_dist_vel(v_max_mph * MPH_TO_M_S)
     d_brake = self.calc_brake_dist(v_max_mph)
 
     #implements algorithm 3.3.2
-    i = 0
-    while not (d_acc + d_brake <= d_tot):
-      print(f"{dist_units_str(d_tot)} is insufficient to accelerate to and brake from {vel_units_str(v_max)}! Lowering v_max by 0.5%")
-      v_max_mph =  v_max_mph * 0.995
-      v_max = v_max_mph * MPH_TO_M_S
+    # d_acc + d_brake increases monotonically with peak speed (from 0 at a stop),
+    # so if d_tot is too short for v_max, solve d_acc(v) + d_brake(v) = d_tot for v on [0, v_max]
+    dist_limited = bool(d_acc + d_brake > d_tot)
+    iterations = 0
+    if dist_limited:
+      from scipy.optimize import brentq
+      dist_err = lambda v_mph: self._calc_accel_dist_vel(v_mph * MPH_TO_M_S) + self.calc_brake_dist(v_mph) - d_tot
+      v_max_mph, res = brentq(dist_err, 0, v_max_mph, xtol=v_tol_mph, full_output=True)
+      iterations = res.iterations
 
       t_acc = self.calc_accel_time(v_max_mph)
-      d_acc = self.calc_accel_dist(t_acc)
-      t_brake = self.calc_brake_time(v_max_mph)
+      d_acc = self._calc_accel_dist_vel(v_max_mph * MPH_TO_M_S)
       d_brake = self.calc_brake_dist(v_max_mph)
+    v_max = v_max_mph * MPH_TO_M_S
+    t_brake = self.calc_brake_time(v_max_mph)
 
-      # d_tot_mi error case
-      if i > 100:
-        print("Error: d_tot_mi is unrealistic; distance is much too short vs. acceleration/deceleration time needed! Travel time cannot be calculated! Check params and their units!")
-        return -1
-      i += 1
-    
     #implements equation 3.1.1
-    d_vmax = d_tot - d_acc - d_brake
+    # (clamped: within v_tol_mph of the root, d_acc + d_brake may overshoot d_tot slightly)
+    d_vmax = max(0.0, d_tot - d_acc - d_brake)
     #implements equation 3.1.2
     t_vmax = d_vmax / v_max
 
     #implements equation 3.2.1
     t_total = t_dwell + t_acc + t_vmax + t_brake
     
-    print(f"Returning stop-to-stop travel time: distance {dist_units_str(d_tot)}, practical top speed {vel_units_str(v_max)}, dwell/buffer time {t_dwell} s")
+    if STATS.enabled:
+      STATS.record_segments(1, int(dist_limited), iterations)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(f"Returning stop-to-stop travel time: distance {dist_units_str(d_tot)}, practical top speed {vel_units_str(v_max)}, dwell/buffer time {t_dwell} s")
+    if diagnostics:
+      info = {"v_peak_mph": v_max_mph,
+              "dist_limited": dist_limited,
+              "t_acc": t_acc, "t_vmax": t_vmax, "t_brake": t_brake,
+              "d_acc": d_acc, "d_vmax": d_vmax, "d_brake": d_brake,
+              "iterations": iterations}
+      return t_total, info
+    return t_total
+
+  @_instrumented
+  def stop_to_stop_times(self, d_tot_mi, v_max_mph, t_dwell=120, v_tol_mph=1e-6, diagnostics=False):
+    '''
+    Batch form of stop_to_stop_time, over many segments at once:
+    d_tot_mi, v_max_mph, t_dwell may be scalars or (broadcastable) arrays, one entry per segment
+    Returns arrays (time (s), peak speed (mph), avg speed (mph)), each -1 where
+    travel time cannot be calculated
+    diagnostics (optional) = if True, also returns a dict of arrays as stop_to_stop_time's info
+    '''
+    d_tot_mi, v_max_mph, t_dwell = np.broadcast_arrays(np.asarray(d_tot_mi, dtype=float),
+                                                       np.asarray(v_max_mph, dtype=float),
+                                                       np.asarray(t_dwell, dtype=float))
+    assert all([np.all(d_tot_mi > 0), np.all(v_max_mph > 0)]), \
+      "The following args must be positive: d_tot_mi, v_max_mph"
+    assert np.all(t_dwell >= 0), \
+      "The following args must be nonnegative: t_dwell"
+    assert v_tol_mph > 0, \
+      "The following args must be positive: v_tol_mph"
+
+    if self.memo is not None and not self.memo.busy and not diagnostics:
+      return self._memo_stop_to_stop_times(d_tot_mi, v_max_mph, t_dwell, v_tol_mph)
+
+    # work on flat arrays, restore the broadcast shape at the end
+    shape = d_tot_mi.shape
+    d_tot_mi, v_max_mph, t_dwell = d_tot_mi.ravel(), v_max_mph.ravel(), t_dwell.ravel()
+    d_tot = d_tot_mi * MI_TO_M
+
+    # v_max_mph error case: unreachable speeds are swapped for 0 until the end
+    valid = np.asarray(self.calc_accel_time(v_max_mph)) != -1
+    if not np.all(valid):
+      logger.error(f"v_max_mph is unrealistic for {np.sum(~valid)} segment(s); speed is not reachable! Travel time cannot be calculated! Check params and their units!")
+    v_max = np.where(valid, v_max_mph, 0) * MPH_TO_M_S
+
+    #implements algorithm 3.3.2, for all distance-limited segments at once
+    d_stop = self._calc_accel_dist_vel(v_max) + self.calc_brake_dist(v_max / MPH_TO_M_S)
+    dist_limited = valid & (d_stop > d_tot)
+    v_peak = v_max.copy()
+    iterations = 0
+    if np.any(dist_limited):
+      v_peak[dist_limited], iterations = self._solve_dist_vel(d_tot[dist_limited], v_max[dist_limited],
+                                                              v_tol_mph * MPH_TO_M_S)
+    v_peak_mph = v_peak / MPH_TO_M_S
+    if STATS.enabled:
+      STATS.record_segments(d_tot.size, int(np.sum(dist_limited)), iterations)
+
+    t_acc = np.asarray(self.calc_accel_time(v_peak_mph))
+    d_acc = np.asarray(self._calc_accel_dist_vel(v_peak))
+    t_brake = np.asarray(self.calc_brake_time(v_peak_mph))
+    d_brake = np.asarray(self.calc_brake_dist(v_peak_mph))
+
+    #implements equations 3.1.1, 3.1.2, 3.2.1
+    d_vmax = np.maximum(0, d_tot - d_acc - d_brake)
+    with np.errstate(divide="ignore", invalid="ignore"):
+      t_vmax = np.where(valid, d_vmax / v_peak, 0)
+    t_total = np.where(valid, t_dwell + t_acc + t_vmax + t_brake, -1)
+    #implements equation 3.2.2, in mph
+    v_avg_mph = np.where(valid, d_tot_mi / (np.where(valid, t_total, 1) / 3600), -1)
+    v_peak_mph = np.where(valid, v_peak_mph, -1)
+
+    res = tuple(_scalar_or_array(x.reshape(shape)) for x in (t_total, v_peak_mph, v_avg_mph))
+    if diagnostics:
+      info = {"dist_limited": dist_limited.reshape(shape),
+              "t_acc": t_acc.reshape(shape), "t_vmax": t_vmax.reshape(shape),
+              "t_brake": t_brake.reshape(shape),
+              "d_acc": d_acc.reshape(shape), "d_vmax": d_vmax.reshape(shape),
+              "d_brake": d_brake.reshape(shape),
+              "iterations": iterations}
+      return res + (info,)
+    return res
+
+  def _memo_stop_to_stop_times(self, d_tot_mi, v_max_mph, t_dwell, v_tol_mph):
+    '''
+    stop_to_stop_times through the memo: segments are snapped and deduplicated,
+    and only distinct segments not yet memoized are calculated (in one batch)
+    '''
+    memo = self.memo
+    shape = d_tot_mi.shape
+    cols = [memo.steps("d", d_tot_mi.ravel()), memo.steps("v", v_max_mph.ravel()), t_dwell.ravel()]
+    # one integer code per distinct (d, v, dwell) segment; 1-d unique is much faster than unique rows
+    code = 0
+    for col in cols:
+      values, col_inverse = np.unique(col, return_inverse=True)
+      code = code * len(values) + col_inverse.ravel()
+    _, first, inverse = np.unique(code, return_index=True, return_inverse=True)
+    segs = np.column_stack(cols)[first]
+    keys = [((int(d_steps), int(v_steps)), (t_dwell_s,), (("v_tol_mph", v_tol_mph),))
+            for d_steps, v_steps, t_dwell_s in segs]
+    res = np.empty((len(segs), 3))
+    missing = []
+    for i, key in enumerate(keys):
+      hit = memo.get("stop_to_stop_times", key)
+      if hit is None:
+        missing.append(i)
+      else:
+        res[i] = hit
+    if missing:
+      memo._local.busy = True
+      try:
+        calc = self.stop_to_stop_times(memo.snap("d", segs[missing, 0]), memo.snap("v", segs[missing, 1]),
+                                       segs[missing, 2], v_tol_mph)
+      finally:
+        memo._local.busy = False
+      res[missing] = np.column_stack(calc)
+      for i in missing:
+        memo.put("stop_to_stop_times", keys[i], tuple(res[i]))
+    inverse = inverse.ravel()
+    return tuple(_scalar_or_array(res[inverse, k].reshape(shape)) for k in range(3))
+
+  @_instrumented
+  def section_run_time(self, d_mi, v_max_mph, t_dwell=120, v_tol_mph=1e-6, diagnostics=False):
+    '''
+    Returns the total arrival-to-arrival travel time (s) from one stop to the next,
+    through consecutive track sections with their own speed limits, without stopping between
+    (eg. passing through skipped stations); with one section, equals stop_to_stop_time
+    Returns -1 if travel time cannot be calculated
+    d_mi = array of section lengths, in order (mi => m)
+    v_max_mph = array of section practical top track speeds (mph => m/s)
+    t_dwell (optional) = dwell/buffer time at first stop (s)
+    v_tol_mph (optional) = tolerance on solved speeds (mph)
+    diagnostics (optional) = if True, returns (time, info) where info is a dict of arrays with:
+      v_bound_mph = speed (mph) at each section boundary, including both stops
+      v_peak_mph = peak speed (mph) within each section
+      t_section = time (s) to traverse each section
+    '''
+    d_mi = np.atleast_1d(np.asarray(d_mi, dtype=float))
+    v_max_mph = np.atleast_1d(np.asarray(v_max_mph, dtype=float))
+    assert d_mi.shape == v_max_mph.shape and d_mi.ndim == 1, \
+      "d_mi and v_max_mph must be 1-d arrays of the same length"
+    assert t_dwell >= 0, \
+      "The following args must be nonnegative: t_dwell"
+
+    # one run of every section
+    res = self.section_run_times(d_mi, v_max_mph, [len(d_mi)], t_dwell, v_tol_mph, diagnostics)
+    if diagnostics:
+      t_total, info = res
+      return (-1, None) if t_total[0] == -1 else (float(t_total[0]), info)
+    return float(res[0])
+
+  @_instrumented
+  def section_run_times(self, d_mi, v_max_mph, run_len, t_dwell=120, v_tol_mph=1e-6, diagnostics=False):
+    '''
+    Batch form of section_run_time, over many runs at once
+    (eg. every stop-to-stop segment of a route, split into sections at its speed restrictions)
+    d_mi, v_max_mph = 1-d arrays of section lengths (mi) and speeds (mph): each run's sections in order, run after run
+    run_len = 1-d array of each run's number of sections
+    t_dwell (optional) = dwell/buffer time at each run's first stop (s), a scalar or one entry per run
+    Returns an array of each run's time (s), -1 where travel time cannot be calculated
+    diagnostics (optional) = if True, returns (times, info), info as section_run_time's, over every run's
+      sections (v_bound_mph: run_len + 1 boundaries per run, run after run); -1 in runs that cannot be calculated
+
+    Both envelope passes are running minima restarted at each run (_run_min_accumulate),
+    so the cost is linear in the total number of sections
+    '''
+    d_mi = np.atleast_1d(np.asarray(d_mi, dtype=float))
+    v_max_mph = np.atleast_1d(np.asarray(v_max_mph, dtype=float))
+    run_len = np.atleast_1d(np.asarray(run_len, dtype=int))
+    assert d_mi.shape == v_max_mph.shape and d_mi.ndim == 1, \
+      "d_mi and v_max_mph must be 1-d arrays of the same length"
+    assert run_len.ndim == 1 and np.all(run_len > 0) and np.sum(run_len) == len(d_mi), \
+      "run_len must be positive section counts, adding up to the number of sections"
+    assert all([np.all(d_mi > 0), np.all(v_max_mph > 0)]), \
+      "The following args must be positive: d_mi, v_max_mph"
+    t_dwell = np.broadcast_to(np.asarray(t_dwell, dtype=float), run_len.shape)
+    assert np.all(t_dwell >= 0), \
+      "The following args must be nonnegative: t_dwell"
+
+    n_runs = len(run_len)
+    run = np.repeat(np.arange(n_runs), run_len)
+    # v_max_mph error case: runs with an unreachable speed are calculated at 1 mph (a placeholder), then set to -1
+    reachable = np.asarray(self.calc_accel_time(v_max_mph)) != -1
+    valid = np.bincount(run, weights=~reachable, minlength=n_runs) == 0
+    if not np.all(valid):
+      logger.error(f"v_max_mph is unrealistic for {np.sum(~valid)} run(s); speed is not reachable! Travel time cannot be calculated! Check params and their units!")
+      v_max_mph = np.where(reachable, v_max_mph, 1)
+
+    d = d_mi * MI_TO_M
+    v_max = v_max_mph * MPH_TO_M_S
+    v_tol = v_tol_mph * MPH_TO_M_S
+    # boundaries: run_len + 1 per run; each section runs from boundary i_in to i_in + 1
+    n_bounds = run_len + 1
+    first = np.cumsum(n_bounds) - n_bounds
+    last = first + run_len
+    i_in = np.arange(len(d)) + run
+    i_out = i_in + 1
+    # boundary positions (m) from each run's start, and speed caps: 0 at both stops, else the lower adjacent limit
+    d_sum = np.cumsum(d)
+    x = np.zeros(np.sum(n_bounds))
+    x[i_out] = d_sum - np.concatenate([[0], d_sum])[first - np.arange(n_runs)][run]
+    v_cap = np.zeros(len(x))
+    inner = np.flatnonzero(i_out[:-1] != last[run[:-1]])
+    v_cap[i_out[inner]] = np.minimum(v_max[inner], v_max[inner + 1])
+
+    # forward pass, in accel-dist coordinates s = d_acc(v): from a boundary at s_i, accelerating
+    # over a section reaches s_i + d_i, capped at the next boundary: s_i+1 = min(d_acc(cap_i+1), s_i + d_i),
+    # which unrolls to a running minimum, s_i = x_i + min over j <= i of (d_acc(cap_j) - x_j)
+    s_fwd = x + _run_min_accumulate(self._calc_accel_dist_vel(v_cap) - x, n_bounds)
+    # backward pass (braking envelope), in brake-dist coordinates likewise, from the end
+    brake_cap = np.asarray(self.calc_brake_dist(v_cap / MPH_TO_M_S))
+    w_bwd = _run_min_accumulate((brake_cap + x)[::-1], n_bounds[::-1])[::-1] - x
+
+    # boundary speeds: the lower of the two envelopes
+    v_fwd = v_cap.copy()
+    below = s_fwd < self._calc_accel_dist_vel(v_cap)
+    if np.any(below):
+      v_fwd[below] = self._solve_dist_vel(s_fwd[below], v_cap[below], v_tol, brake=False)[0]
+    v_bound = np.minimum(v_fwd, self._calc_brake_vel_dist(w_bwd))
+    v_bound[first] = 0
+    v_bound[last] = 0
+    v_in = v_bound[i_in]
+    v_out = v_bound[i_out]
+
+    # within each section: accelerate from v_in, cruise at v_max, brake to v_out;
+    # if the section is too short to reach v_max, solve for the peak speed, as stop_to_stop_time
+    d_acc_in = self._calc_accel_dist_vel(v_in)
+    d_brake_out = np.asarray(self.calc_brake_dist(v_out / MPH_TO_M_S))
+    d_target = d + d_acc_in + d_brake_out
+    v_peak = v_max.copy()
+    dist_limited = self._calc_accel_dist_vel(v_max) + np.asarray(self.calc_brake_dist(v_max_mph)) > d_target
+    if np.any(dist_limited):
+      v_peak[dist_limited] = self._solve_dist_vel(d_target[dist_limited], v_max[dist_limited], v_tol,
+                                                  v_lo=np.maximum(v_in, v_out)[dist_limited])[0]
+    v_peak_mph = v_peak / MPH_TO_M_S
+
+    d_acc = self._calc_accel_dist_vel(v_peak) - d_acc_in
+    d_brake = np.asarray(self.calc_brake_dist(v_peak_mph)) - d_brake_out
+    t_acc = np.asarray(self.calc_accel_time(v_peak_mph)) - np.asarray(self.calc_accel_time(v_in / MPH_TO_M_S))
+    t_brake = np.asarray(self.calc_brake_time(v_peak_mph)) - np.asarray(self.calc_brake_time(v_out / MPH_TO_M_S))
+    #implements equations 3.1.1, 3.1.2, per section
+    t_vmax = np.maximum(0, d - d_acc - d_brake) / v_peak
+    t_section = t_acc + t_vmax + t_brake
+
+    #implements equation 3.2.1, per run
+    t_total = np.where(valid, t_dwell + np.bincount(run, weights=t_section, minlength=n_runs), -1)
+    if diagnostics:
+      info = {"v_bound_mph": np.where(valid[np.repeat(np.arange(n_runs), n_bounds)], v_bound / MPH_TO_M_S, -1),
+              "v_peak_mph": np.where(valid[run], v_peak_mph, -1),
+              "t_section": np.where(valid[run], t_section, -1)}
+      return t_total, info
     return t_total
 
-  def plot_vel_curve(self, v_max_mph, accel=True):
+  def plot_vel_curve(self, v_max_mph, accel=True, out_path=None):
     '''accel=True: Displays a plot of v (acceleration up to v_max_mph) as a function of t (s)'''
     '''accel=False: Displays a plot of v (braking down from v_max_mph) as a function of t (s)'''
+    '''out_path (optional): writes the plot to this file (eg. .png, .svg) instead, without a display'''
     assert v_max_mph > 0, \
       "The following args must be positive: v_max_mph"
 
@@ -287,18 +917,27 @@ class Train():
       t_max = self.calc_accel_time(v_max_mph)
       # get v vs t at 1000 evenly-distributed points
       x_t = np.linspace(0, t_max, 1000)
-      y_v = np.array([self.calc_accel_vel(t) for t in x_t])
+      y_v = self.calc_accel_vel(x_t)
       title = "Acceleration"
     else:
       t_max = self.calc_brake_time(v_max_mph)
       x_t = np.linspace(0, t_max, 1000)
-      y_v = np.array([self.calc_brake_vel(t, v_max_mph) for t in x_t])
+      y_v = self.calc_brake_vel(x_t, v_max_mph)
       title = "Braking"
 
     # convert speeds back to mph
     y_v = y_v / MPH_TO_M_S
 
-    fig, ax = plt.subplots()
+    if out_path is None:
+      import matplotlib.pyplot as plt
+      fig, ax = plt.subplots()
+    else:
+      # headless: a standalone Agg figure, no pyplot
+      from matplotlib.figure import Figure
+      from matplotlib.backends.backend_agg import FigureCanvasAgg
+      fig = Figure()
+      FigureCanvasAgg(fig)
+      ax = fig.add_subplot()
     # show v ticks every 5 mph
     ax.set_yticks([i for i in range(0, int(np.ceil(v_max_mph)) + 6, 5)])
 
@@ -313,9 +952,410 @@ class Train():
 
     ax.set_xticks([i for i in range(0, int(np.ceil(t_max)) + t_gran + 1, t_gran)])
     
-    plt.plot(x_t, y_v)
-    plt.grid(linestyle = 'dotted')
-    plt.title(title)
-    plt.xlabel('Time (s)')
-    plt.ylabel('Speed (mph)')
-    plt.show()
\ No newline at end of file
+    ax.plot(x_t, y_v)
+    ax.grid(linestyle = 'dotted')
+    ax.set_title(title)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Speed (mph)')
+    if out_path is None:
+      plt.show()
+    else:
+      fig.savefig(out_path)
+
+class TrainBatch(_TrainCurves):
+  # per-consist parameters, stored as arrays
+  PARAMS = ("m", "P", "F", "brake_a1", "brake_a2", "brake_v1", "D", "v_1", "t_1")
+
+  def __init__(self,
+               m_lb,
+               P_hp,
+               F_lbf,
+               brake_a1_mphps=BRAKE_A1_MPHPS,
+               brake_a2_mphps=BRAKE_A2_MPHPS,
+               brake_v1_mph=BRAKE_V1_MPH,
+               D=0):
+    '''
+    Initialize a batch of many consists from args, as Train;
+    each arg may be a scalar (shared by all consists) or an array, one entry per consist
+    
+    Parameters are stored as column arrays (consists x 1), so the calc_* methods (shared with Train),
+    given an array of n speeds (or times), broadcast to a consists x n matrix;
+    Train's scalar-only methods (stop_to_stop_time, section runs, memo, plots) are not available
+    '''
+    m_lb, P_hp, F_lbf, brake_a1_mphps, brake_a2_mphps, brake_v1_mph, D = \
+      np.broadcast_arrays(*[np.atleast_1d(np.asarray(x, dtype=float))
+                            for x in (m_lb, P_hp, F_lbf, brake_a1_mphps, brake_a2_mphps, brake_v1_mph, D)])
+    assert m_lb.ndim == 1, \
+      "TrainBatch args must be scalars or 1-d arrays"
+    assert all([np.all(m_lb > 0), np.all(P_hp > 0), np.all(F_lbf > 0)]), \
+      "The following args must be positive: m_lb, P_hp, F_lbf"
+    assert np.all(D >= 0), \
+      "The following args must be nonnegative: D"
+
+    self.m = (m_lb * LB_TO_KG)[:, None]
+    self.P = (P_hp * HP_TO_W)[:, None]
+    self.F = (F_lbf * LBF_TO_N)[:, None]
+
+    self.brake_a1 = (brake_a1_mphps * MPH_TO_M_S)[:, None]
+    self.brake_a2 = (brake_a2_mphps * MPH_TO_M_S)[:, None]
+    self.brake_v1 = (brake_v1_mph * MPH_TO_M_S)[:, None]
+
+    self.D = D[:, None]
+    # implements equations 1.1.1, 1.1.2
+    self.v_1 = self.P / self.F
+    self.t_1 = self.m * self.P / (self.F**2)
+    if logger.isEnabledFor(logging.INFO):
+      logger.info(f"Initializing batch of {len(self)} trains")
+
+  @classmethod
+  def from_trains(cls, trains):
+    '''Returns a TrainBatch of the given Trains, in order'''
+    batch = cls.__new__(cls)
+    for name in cls.PARAMS:
+      setattr(batch, name, np.array([getattr(train, name) for train in trains], dtype=float)[:, None])
+    return batch
+
+  def __len__(self):
+    return self.m.shape[0]
+
+  def _elementwise(self, mask):
+    '''
+    Returns a TrainBatch with one consist per True entry of a consists x segments mask
+    (each entry's consist, in mask order), to solve entries elementwise
+    '''
+    batch = TrainBatch.__new__(TrainBatch)
+    for name in self.PARAMS:
+      setattr(batch, name, np.broadcast_to(getattr(self, name), mask.shape)[mask])
+    return batch
+
+  @_instrumented
+  def stop_to_stop_times(self, d_tot_mi, v_max_mph, t_dwell=120, v_tol_mph=1e-6):
+    '''
+    Stop-to-stop times of every consist over many segments at once:
+    d_tot_mi, v_max_mph, t_dwell may be scalars or (broadcastable) arrays, one entry per segment
+    Returns consists x segments arrays (time (s), peak speed (mph), avg speed (mph)),
+    each -1 where travel time cannot be calculated; route totals are the sums over segments
+    '''
+    d_tot_mi, v_max_mph, t_dwell = np.broadcast_arrays(np.asarray(d_tot_mi, dtype=float),
+                                                       np.asarray(v_max_mph, dtype=float),
+                                                       np.asarray(t_dwell, dtype=float))
+    assert all([np.all(d_tot_mi > 0), np.all(v_max_mph > 0)]), \
+      "The following args must be positive: d_tot_mi, v_max_mph"
+    assert np.all(t_dwell >= 0), \
+      "The following args must be nonnegative: t_dwell"
+    assert v_tol_mph > 0, \
+      "The following args must be positive: v_tol_mph"
+
+    # segments are flattened to one axis; consists x segments throughout, reshaped at the end
+    shape = (len(self),) + d_tot_mi.shape
+    d_tot_mi, v_max_mph, t_dwell = d_tot_mi.ravel(), v_max_mph.ravel(), t_dwell.ravel()
+    d_tot = d_tot_mi * MI_TO_M
+
+    # v_max_mph error case: unreachable speeds are swapped for 0 until the end
+    valid = np.asarray(self.calc_accel_time(v_max_mph)) != -1
+    if not np.all(valid):
+      logger.error(f"v_max_mph is unrealistic for {np.sum(~valid)} consist-segment(s); speed is not reachable! Travel time cannot be calculated! Check params and their units!")
+    v_max = np.where(valid, v_max_mph, 0) * MPH_TO_M_S
+
+    #implements algorithm 3.3.2, for all distance-limited consist-segments at once
+    d_stop = self._calc_accel_dist_vel(v_max) + self.calc_brake_dist(v_max / MPH_TO_M_S)
+    dist_limited = valid & (d_stop > d_tot)
+    v_peak = v_max.copy()
+    iterations = 0
+    if np.any(dist_limited):
+      d_target = np.broadcast_to(d_tot, dist_limited.shape)[dist_limited]
+      v_peak[dist_limited], iterations = self._elementwise(dist_limited)._solve_dist_vel(
+        d_target, v_max[dist_limited], v_tol_mph * MPH_TO_M_S)
+    v_peak_mph = v_peak / MPH_TO_M_S
+    if STATS.enabled:
+      STATS.record_segments(v_peak.size, int(np.sum(dist_limited)), iterations)
+
+    t_acc = self.calc_accel_time(v_peak_mph)
+    d_acc = self._calc_accel_dist_vel(v_peak)
+    t_brake = self.calc_brake_time(v_peak_mph)
+    d_brake = self.calc_brake_dist(v_peak_mph)
+
+    #implements equations 3.1.1, 3.1.2, 3.2.1
+    d_vmax = np.maximum(0, d_tot - d_acc - d_brake)
+    with np.errstate(divide="ignore", invalid="ignore"):
+      t_vmax = np.where(valid, d_vmax / v_peak, 0)
+    t_total = np.where(valid, t_dwell + t_acc + t_vmax + t_brake, -1)
+    #implements equation 3.2.2, in mph
+    v_avg_mph = np.where(valid, d_tot_mi / (np.where(valid, t_total, 1) / 3600), -1)
+    v_peak_mph = np.where(valid, v_peak_mph, -1)
+    return tuple(x.reshape(shape) for x in (t_total, v_peak_mph, v_avg_mph))
+
+### on-disk format version of TrainProfile tables; bump to invalidate cached tables ###
+PROFILE_VERSION = 1
+### names of the TrainProfile error bounds, in the order they are stored ###
+ERR_BOUND_KEYS = ("t_acc", "d_acc", "t_brake", "d_brake", "v_acc", "d_acc_t")
+
+def _load_npz_mmap(path):
+  '''
+  Returns a dict of read-only memory-mapped arrays, one per member of an uncompressed .npz
+  (np.load does not memory-map .npz members, so map each member's data by its file offset)
+  '''
+  arrays = {}
+  with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+    for info in zf.infolist():
+      assert info.compress_type == zipfile.ZIP_STORED, \
+        f"{path} must be an uncompressed .npz to be memory-mapped!"
+      # skip the zip local file header: fixed 30 bytes, then name and extra field
+      f.seek(info.header_offset + 26)
+      name_len, extra_len = np.frombuffer(f.read(4), dtype="<u2")
+      f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+      # then the .npy header
+      if np.lib.format.read_magic(f) == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+      else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+      arrays[info.filename[:-4]] = np.memmap(path, dtype=dtype, mode="r", offset=f.tell(),
+                                             shape=shape, order="F" if fortran_order else "C")
+  return arrays
+
+
+class TrainProfile():
+  def __init__(self, train, v_top_mph=250, n_points=4001, cache_dir=None):
+    '''
+    Precomputes a Train's acceleration and braking curves on a dense velocity grid,
+    then answers the same queries as Train by linear interpolation
+    train = Train to tabulate
+    v_top_mph (optional) = top of the velocity grid (mph => m/s);
+      capped just below the drag-limited top speed; queries above it fall back to train
+    n_points (optional) = number of velocity grid points
+    cache_dir (optional) = directory to save/load tables as .npz, keyed by a hash of all params
+
+    After init, err_bound holds the max interpolation error of each table,
+    measured against train at the midpoints between grid points (where it peaks):
+      t_acc (s), d_acc (m), t_brake (s), d_brake (m) as functions of v
+      v_acc (m/s), d_acc_t (m) as functions of t
+    '''
+    assert isinstance(train, Train), \
+      "TrainProfile tabulates one Train; for a TrainBatch, tabulate a Train per consist"
+    assert all([v_top_mph > 0, n_points > 1]), \
+      "The following args must be positive: v_top_mph, n_points - 1"
+
+    self.train = train
+    v_top = v_top_mph * MPH_TO_M_S
+    if train.D > 0:
+      # top speed where power balances drag; t(v) diverges there
+      v_top = min(v_top, 0.999 * np.cbrt(train.P / train.D))
+    self.v_top_mph = v_top / MPH_TO_M_S
+    self.n_points = n_points
+
+    self.key = self.calc_key()
+    self.path = None
+    if cache_dir is not None:
+      self.path = os.path.join(cache_dir, f"profile_{self.key}.npz")
+
+    if self.path is not None and os.path.exists(self.path):
+      tables = _load_npz_mmap(self.path)
+    else:
+      tables = self.calc_tables()
+      if self.path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write then rename, so concurrent runs never read a partial file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+          np.savez(f, **tables)
+        os.replace(tmp_path, self.path)
+
+    self.v = tables["v"]
+    self.t_acc = tables["t_acc"]
+    self.d_acc = tables["d_acc"]
+    self.t_brake = tables["t_brake"]
+    self.d_brake = tables["d_brake"]
+    self.err_bound = dict(zip(ERR_BOUND_KEYS, (float(e) for e in tables["err_bound"])))
+
+  def calc_key(self):
+    '''Returns a hash of every param the tables depend on'''
+    params = [PROFILE_VERSION, self.train.m, self.train.P, self.train.F, self.train.D,
+              self.train.brake_a1, self.train.brake_a2, self.train.brake_v1,
+              self.v_top_mph, self.n_points]
+    return hashlib.sha256(repr(params).encode()).hexdigest()[0:16]
+
+  def calc_tables(self):
+    '''Returns the tabulated curves as a dict of arrays, plus their error bounds'''
+    train = self.train
+    v_top = self.v_top_mph * MPH_TO_M_S
+    # uniform grid, plus both kinks (v_1 and brake_v1) so they are interpolated exactly
+    v = np.linspace(0, v_top, self.n_points)
+    if train.D > 0:
+      # t(v) diverges at the drag-limited top speed c, so above 0.9c space points
+      # geometrically in (c - v), to keep interpolation error even as the curve steepens
+      c = np.cbrt(train.P / train.D)
+      if v_top > 0.9 * c:
+        v = v[v < 0.9 * c]
+        v_tail = c - np.geomspace(0.1 * c, c - v_top, self.n_points // 4)
+        v = np.concatenate([v, v_tail])
+    v = np.unique(np.concatenate([v, [train.v_1, train.brake_v1]]))
+    v = v[v <= v_top]
+    v_mph = v / MPH_TO_M_S
+    tables = {"v": v,
+              "t_acc": train.calc_accel_time(v_mph),
+              "d_acc": train._calc_accel_dist_vel(v),
+              "t_brake": train.calc_brake_time(v_mph),
+              "d_brake": train.calc_brake_dist(v_mph)}
+
+    v_mid = 0.5 * (v[1:] + v[:-1])
+    v_mid_mph = v_mid / MPH_TO_M_S
+    t_mid = 0.5 * (tables["t_acc"][1:] + tables["t_acc"][:-1])
+    err_bound = [
+      np.max(np.abs(np.interp(v_mid, v, tables["t_acc"]) - train.calc_accel_time(v_mid_mph))),
+      np.max(np.abs(np.interp(v_mid, v, tables["d_acc"]) - train._calc_accel_dist_vel(v_mid))),
+      np.max(np.abs(np.interp(v_mid, v, tables["t_brake"]) - train.calc_brake_time(v_mid_mph))),
+      np.max(np.abs(np.interp(v_mid, v, tables["d_brake"]) - train.calc_brake_dist(v_mid_mph))),
+      np.max(np.abs(np.interp(t_mid, tables["t_acc"], v) - train.calc_accel_vel(t_mid))),
+      np.max(np.abs(np.interp(t_mid, tables["t_acc"], tables["d_acc"]) - train.calc_accel_dist(t_mid)))]
+    tables["err_bound"] = np.array(err_bound)
+    return tables
+
+  def _interp_v(self, v_mph, table, exact):
+    '''Returns table interpolated at v_mph (mph => m/s); above the grid, falls back to exact'''
+    v_mph = np.asarray(v_mph, dtype=float)
+    assert np.all(v_mph >= 0), \
+      "The following args must be nonnegative: v_mph"
+    res = np.interp(v_mph * MPH_TO_M_S, self.v, table)
+    above = v_mph > self.v_top_mph
+    if np.any(above):
+      res = np.where(above, exact(np.where(above, v_mph, 0)), res)
+    return _scalar_or_array(res)
+
+  def _interp_t(self, t, table, exact):
+    '''Returns table interpolated at t (s) of acceleration; past the grid, falls back to exact'''
+    t = np.asarray(t, dtype=float)
+    res = np.interp(t, self.t_acc, table)
+    above = t > self.t_acc[-1]
+    if np.any(above):
+      res = np.where(above, exact(np.where(above, t, self.t_acc[-1])), res)
+    return _scalar_or_array(res)
+
+  @_instrumented
+  def calc_accel_time(self, v_mph):
+    '''Returns the time required to reach v_mph (mph => m/s), -1 if unable'''
+    return self._interp_v(v_mph, self.t_acc, self.train.calc_accel_time)
+
+  @_instrumented
+  def calc_accel_vel(self, t):
+    '''Returns the v (m/s) after t (s) of acceleration'''
+    assert np.all(np.asarray(t) >= 0), \
+      "The following args must be nonnegative: t"
+    return self._interp_t(t, self.v, self.train.calc_accel_vel)
+
+  @_instrumented
+  def calc_accel_dist(self, t):
+    '''Returns the dist (m) traveled after t (s) of acceleration'''
+    assert np.all(np.asarray(t) > 0), \
+      "The following args must be positive: t"
+    return self._interp_t(t, self.d_acc, self.train.calc_accel_dist)
+
+  @_instrumented
+  def calc_brake_time(self, v_mph):
+    '''Returns the time (s) required to brake to a stop from v_mph (mph => m/s)'''
+    return self._interp_v(v_mph, self.t_brake, self.train.calc_brake_time)
+
+  @_instrumented
+  def calc_brake_vel(self, t, v_mph):
+    '''Returns the velocity (m/s) after t (s) of braking from v_mph (mph => m/s)'''
+    assert np.all(np.asarray(t) >= 0), \
+      "The following args must be nonnegative: t"
+    # braking time left is the brake curve's time from v_mph, minus t
+    t_left = np.maximum(0, np.asarray(self.calc_brake_time(v_mph)) - t)
+    return _scalar_or_array(np.interp(t_left, self.t_brake, self.v))
+
+  @_instrumented
+  def calc_brake_dist(self, v_mph):
+    '''Returns the dist (m) required to brake to a stop from v_mph (mph => m/s)'''
+    return self._interp_v(v_mph, self.d_brake, self.train.calc_brake_dist)
+
+  @_instrumented
+  def stop_to_stop_time(self, d_tot_mi, v_max_mph, t_dwell=120, diagnostics=False):
+    '''
+    Returns the total arrival-to-arrival travel time (s) from one stop to the next,
+    as Train.stop_to_stop_time, but from the tables
+    d_tot_mi, v_max_mph, t_dwell may be scalars or (broadcastable) arrays
+    Segments with v_max_mph above the grid fall back to train (in one batch);
+    returns -1 where travel time cannot be calculated
+    diagnostics (optional) = if True, returns (time, info), with info as Train.stop_to_stop_time
+    '''
+    d_tot_mi, v_max_mph, t_dwell = np.broadcast_arrays(np.asarray(d_tot_mi, dtype=float),
+                                                       np.asarray(v_max_mph, dtype=float),
+                                                       np.asarray(t_dwell, dtype=float))
+    assert all([np.all(d_tot_mi > 0), np.all(v_max_mph > 0)]), \
+      "The following args must be positive: d_tot_mi, v_max_mph"
+    assert np.all(t_dwell >= 0), \
+      "The following args must be nonnegative: t_dwell"
+
+    d_tot = d_tot_mi * MI_TO_M
+    v_max = v_max_mph * MPH_TO_M_S
+    # above the grid, the tables cannot answer; those segments are calculated by train below
+    valid = v_max_mph <= self.v_top_mph
+
+    #implements algorithm 3.3.2
+    # d_acc + d_brake is tabulated and monotone in v, so the peak speed
+    # of a distance-limited segment is read off the table directly
+    d_stop = self.d_acc + self.d_brake
+    dist_limited = np.interp(v_max, self.v, d_stop) > d_tot
+    v_peak = np.where(dist_limited, np.minimum(np.interp(d_tot, d_stop, self.v), v_max), v_max)
+
+    t_acc = np.interp(v_peak, self.v, self.t_acc)
+    d_acc = np.interp(v_peak, self.v, self.d_acc)
+    t_brake = np.interp(v_peak, self.v, self.t_brake)
+    d_brake = np.interp(v_peak, self.v, self.d_brake)
+
+    #implements equations 3.1.1, 3.1.2, 3.2.1
+    d_vmax = np.maximum(0, d_tot - d_acc - d_brake)
+    t_vmax = d_vmax / v_peak
+    t_total = np.where(valid, t_dwell + t_acc + t_vmax + t_brake, -1)
+    v_peak_mph = v_peak / MPH_TO_M_S
+    iterations = 0
+    if STATS.enabled:
+      STATS.record_segments(int(np.sum(valid)), int(np.sum(dist_limited & valid)), 0)
+
+    above = ~valid
+    if np.any(above):
+      t_exact, v_peak_exact, _, info_exact = self.train.stop_to_stop_times(
+        d_tot_mi[above], v_max_mph[above], t_dwell[above], diagnostics=True)
+      iterations = info_exact.pop("iterations")
+      exact = dict(info_exact, t_total=t_exact, v_peak_mph=v_peak_exact)
+      fields = {"t_total": t_total, "v_peak_mph": v_peak_mph, "dist_limited": dist_limited,
+                "t_acc": t_acc, "t_vmax": t_vmax, "t_brake": t_brake,
+                "d_acc": d_acc, "d_vmax": d_vmax, "d_brake": d_brake}
+      for name, values in fields.items():
+        values = np.array(values)
+        values[above] = exact[name]
+        fields[name] = values
+      (t_total, v_peak_mph, dist_limited, t_acc, t_vmax, t_brake,
+       d_acc, d_vmax, d_brake) = fields.values()
+
+    t_total = _scalar_or_array(t_total)
+    if diagnostics:
+      info = {"v_peak_mph": _scalar_or_array(v_peak_mph),
+              "dist_limited": dist_limited if dist_limited.ndim else bool(dist_limited),
+              "t_acc": _scalar_or_array(t_acc), "t_vmax": _scalar_or_array(t_vmax),
+              "t_brake": _scalar_or_array(t_brake),
+              "d_acc": _scalar_or_array(d_acc), "d_vmax": _scalar_or_array(d_vmax),
+              "d_brake": _scalar_or_array(d_brake),
+              "iterations": iterations}
+      return t_total, info
+    return t_total
+
+  @_instrumented
+  def stop_to_stop_times(self, d_tot_mi, v_max_mph, t_dwell=120, diagnostics=False):
+    '''
+    Batch form of stop_to_stop_time, as Train.stop_to_stop_times, but from the tables
+    Returns arrays (time (s), peak speed (mph), avg speed (mph)), each -1 where
+    travel time cannot be calculated
+    '''
+    t_total, info = self.stop_to_stop_time(d_tot_mi, v_max_mph, t_dwell, diagnostics=True)
+    t_total = np.asarray(t_total)
+    valid = t_total != -1
+    d_tot_mi = np.broadcast_to(np.asarray(d_tot_mi, dtype=float), t_total.shape)
+    #implements equation 3.2.2, in mph
+    v_avg_mph = np.where(valid, d_tot_mi / (np.where(valid, t_total, 1) / 3600), -1)
+    v_peak_mph = np.where(valid, info.pop("v_peak_mph"), -1)
+
+    res = (_scalar_or_array(t_total), _scalar_or_array(v_peak_mph), _scalar_or_array(v_avg_mph))
+    if diagnostics:
+      return res + (info,)
+    return res
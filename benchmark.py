@@ -0,0 +1,170 @@
+from CTrain import *
+from timetable import *
+import argparse
+import pandas as pd
+from scipy.optimize import brentq
+import datetime
+import platform
+import subprocess
+import tempfile
+import timeit
+
+### accuracy tolerances vs. quad-based reference (s of stop-to-stop time) ###
+EXACT_TOL_S = 1e-3
+PROFILE_TOL_S = 1e-2
+
+def synthetic_trains():
+    '''
+    Returns {name: Train} of consists to benchmark:
+    the sample .json consists, plus synthetic light/heavy/drag-free consists
+    '''
+    trains = {
+        "sample_train_A": load_train("sample_train_A.json"),
+        "sample_train_A_nobrake": load_train("sample_train_A_nobrake.json"),
+        "emu_light": Train(m_lb=400000.0, P_hp=6000, F_lbf=60000.0, brake_a1_mphps=3.0, brake_a2_mphps=2.0,
+                           D=calc_D(h_in=150, w_in=120, C_d=0.5)),
+        "freight_heavy": Train(m_lb=12000000.0, P_hp=13000, F_lbf=400000.0, brake_a1_mphps=1.0, brake_a2_mphps=0.8,
+                               brake_v1_mph=40, D=calc_D(h_in=200, w_in=128, C_d=1.0)),
+        "no_drag": Train(m_lb=1172000.0, P_hp=3900, F_lbf=65000.0, D=0),
+    }
+    return trains
+
+def synthetic_route(n_stops, seed=0):
+    '''
+    Returns a route dataframe of n_stops stops (see sample .csv for format),
+    mixing short distance-limited segments with long speed-limited ones
+    '''
+    rng = np.random.default_rng(seed)
+    dists = np.round(np.where(rng.random(n_stops - 1) < 0.5,
+                              rng.uniform(0.2, 2, n_stops - 1),
+                              rng.uniform(2, 20, n_stops - 1)), 2)
+    speeds = rng.integers(20, 110, n_stops - 1)
+    return pd.DataFrame({'arrival stop': [f"stop {i}" for i in range(n_stops)],
+                         'track speed (mph)': np.concatenate([[0], speeds]),
+                         'dist (mi)': np.concatenate([[0], dists])})
+
+def reference_stop_to_stop_time(train, d_tot_mi, v_max_mph, t_dwell=120):
+    '''
+    Returns stop-to-stop time (s) with every acceleration distance integrated by quad
+    (calc_accel_dist(method="reference")), and the peak speed solved to a tight tolerance
+    '''
+    d_tot = d_tot_mi * MI_TO_M
+    def d_stop(v_mph):
+        t_acc = train.calc_accel_time(v_mph)
+        d_acc = train.calc_accel_dist(t_acc, method="reference") if t_acc > 0 else 0
+        return d_acc + train.calc_brake_dist(v_mph)
+    if d_stop(v_max_mph) > d_tot:
+        v_max_mph = brentq(lambda v_mph: d_stop(v_mph) - d_tot, 0, v_max_mph, xtol=1e-9)
+    d_vmax = max(0.0, d_tot - d_stop(v_max_mph))
+    return t_dwell + train.calc_accel_time(v_max_mph) + d_vmax / (v_max_mph * MPH_TO_M_S) \
+        + train.calc_brake_time(v_max_mph)
+
+def time_call(func, min_time=0.2):
+    '''Returns the best per-call wall time (s) of func, over repeated timing rounds'''
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+def bench_kernels(name, train):
+    '''Returns {kernel: seconds per call} for one Train'''
+    res = {}
+    t_max = train.calc_accel_time(100)
+    t_batch = np.linspace(0, t_max, 10000)
+    res["calc_accel_vel (scalar)"] = time_call(lambda: train.calc_accel_vel(t_max))
+    res["calc_accel_vel (10k batch)"] = time_call(lambda: train.calc_accel_vel(t_batch))
+    res["calc_accel_dist (analytic)"] = time_call(lambda: train.calc_accel_dist(t_max))
+    res["calc_accel_dist (reference)"] = time_call(lambda: train.calc_accel_dist(t_max, method="reference"))
+    res["calc_accel_dist (10k batch)"] = time_call(lambda: train.calc_accel_dist(t_batch[1:]))
+    res["calc_brake_dist (scalar)"] = time_call(lambda: train.calc_brake_dist(100))
+    res["stop_to_stop_time (speed-limited)"] = time_call(lambda: train.stop_to_stop_time(20, 60))
+    res["stop_to_stop_time (distance-limited)"] = time_call(lambda: train.stop_to_stop_time(0.5, 100))
+
+    profile = TrainProfile(train)
+    res["TrainProfile build"] = time_call(lambda: TrainProfile(train), min_time=0.05)
+    res["TrainProfile.stop_to_stop_time (distance-limited)"] = time_call(lambda: profile.stop_to_stop_time(0.5, 100))
+    return res
+
+def bench_accuracy(train, n_segments=50, seed=0):
+    '''
+    Returns the max abs error (s) of each fast stop-to-stop path
+    vs. reference_stop_to_stop_time, over random segments
+    '''
+    route_df = synthetic_route(n_segments + 1, seed=seed).iloc[1:]
+    dists = route_df['dist (mi)'].to_numpy(dtype=float)
+    speeds = route_df['track speed (mph)'].to_numpy(dtype=float)
+    ref = np.array([reference_stop_to_stop_time(train, d, v) for d, v in zip(dists, speeds)])
+
+    scalar = np.array([train.stop_to_stop_time(d, v) for d, v in zip(dists, speeds)])
+    batch = train.stop_to_stop_times(dists, speeds)[0]
+    profile = TrainProfile(train).stop_to_stop_times(dists, speeds)[0]
+    return {"stop_to_stop_time": float(np.max(np.abs(scalar - ref))),
+            "stop_to_stop_times": float(np.max(np.abs(batch - ref))),
+            "TrainProfile.stop_to_stop_times": float(np.max(np.abs(profile - ref)))}
+
+def bench_timetables(name, train, sizes, out_dir):
+    '''Returns {n_stops: seconds} for end-to-end calc_timetable + .csv round trip, per route size'''
+    res = {}
+    for n_stops in sizes:
+        route_csv = os.path.join(out_dir, f"route_{n_stops}.csv")
+        if not os.path.exists(route_csv):
+            synthetic_route(n_stops).to_csv(route_csv, index=False)
+        out_csv = os.path.join(out_dir, f"route_{n_stops}_{name}_timetable.csv")
+        def run():
+            calc_timetable(train, load_route(route_csv)).to_csv(out_csv, index=False)
+        res[str(n_stops)] = time_call(run, min_time=0.05)
+    return res
+
+def git_revision():
+    '''Returns the current git commit hash, or None outside a git checkout'''
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    '''
+    Benchmark suite
+    Times CTrain kernels and end-to-end timetable generation on several consists and synthetic routes,
+    checks fast paths against the quad-based reference, and writes results to a .json file
+    Sample usage: benchmark.py -o bench_results.json -n 10 1000 100000
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--outfile", required=False, default="bench_results.json", help="(optional) .json file to write results to")
+    parser.add_argument("-n", "--stops", required=False, nargs="+", type=int, default=[10, 1000, 100000], help="(optional) synthetic route sizes, in number of stops")
+    parser.add_argument("-a", "--accuracy-segments", required=False, type=int, default=50, help="(optional) number of random segments to check against the reference")
+    args = parser.parse_args()
+
+    assert all(n_stops >= 2 for n_stops in args.stops), \
+        "--stops must each be at least 2!"
+
+    results = {"revision": git_revision(),
+               "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "consists": {}}
+    failed = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for name, train in synthetic_trains().items():
+            print(f"Benchmarking {name}...")
+            accuracy = bench_accuracy(train, args.accuracy_segments)
+            results["consists"][name] = {"kernels (s/call)": bench_kernels(name, train),
+                                         "timetable (s/route)": bench_timetables(name, train, args.stops, out_dir),
+                                         "max abs error vs. reference (s)": accuracy}
+            for path, err in accuracy.items():
+                tol = PROFILE_TOL_S if path.startswith("TrainProfile") else EXACT_TOL_S
+                if not err <= tol:
+                    failed.append(f"{name}: {path} off by {err} s (tolerance {tol} s)")
+
+    with open(args.outfile, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.outfile}")
+
+    if failed:
+        print("Accuracy check FAILED:")
+        for line in failed:
+            print("  " + line)
+        raise SystemExit(1)
+    print("Accuracy check passed")
@@ -1,6 +1,10 @@
 from CTrain import *
+import logging
 
-if __name__ == "__main__":  
+if __name__ == "__main__":
+    # show Train details and stop-to-stop calculations, logged by CTrain
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("CTrain").setLevel(logging.DEBUG)  
     # 1. combined coefficient of drag
     print("\nDEMO 1. combined coefficient of drag")
     D = calc_D(h_in=15*12+7.5, w_in=10*12+3, C_d=0.8)
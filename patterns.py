@@ -0,0 +1,117 @@
+from CTrain import *
+from timetable import *
+import argparse
+import numpy as np
+import pandas as pd
+
+class PatternEngine():
+    def __init__(self, train, route_df, t_dwell=120):
+        '''
+        Evaluates stopping patterns (local, limited, express...) of one Train over one route
+        train = Train to run
+        route_df = route dataframe (load_route); each row's 'track speed (mph)' and 'dist (mi)'
+        describe the track section from the previous stop
+        t_dwell (optional) = dwell/buffer time at each stop served (s)
+
+        A run between two served stops passes through skipped stops without stopping
+        (Train.section_run_time), and through every speed restriction (parse_restrictions);
+        runs are cached by (from stop, to stop), so patterns sharing a run only calculate it once
+        '''
+        self.train = train
+        self.t_dwell = t_dwell
+        self.stops = route_df['arrival stop'].to_numpy() if 'arrival stop' in route_df else np.arange(len(route_df))
+        self.dists = route_df['dist (mi)'].to_numpy(dtype=float)
+        self.speeds = route_df['track speed (mph)'].to_numpy(dtype=float)
+        # each row's sections (length (mi), speed limit (mph)): the whole row, or split at its restrictions
+        self.sections = [(self.dists[row:row + 1], self.speeds[row:row + 1]) for row in range(len(route_df))]
+        rows, starts, ends, r_speeds = parse_restrictions(route_df)
+        if len(rows) > 0:
+            seg_rows, d_sec, v_sec, run_len = restricted_sections(self.dists, self.speeds, rows, starts, ends, r_speeds)
+            splits = np.cumsum(run_len)[:-1]
+            for row, d_row, v_row in zip(seg_rows, np.split(d_sec, splits), np.split(v_sec, splits)):
+                self.sections[row] = (d_row, v_row)
+        # run time (s, without dwell) between stop indices (i, j)
+        self.runs = {}
+
+    def run_time(self, i, j):
+        '''Returns the run time (s, without dwell) from stop i to stop j, passing any stops between'''
+        assert 0 <= i < j < len(self.stops), \
+            "Stops must be in route order: 0 <= i < j < number of stops"
+        if (i, j) not in self.runs:
+            d_mi = np.concatenate([d_row for d_row, _ in self.sections[i + 1:j + 1]])
+            v_max_mph = np.concatenate([v_row for _, v_row in self.sections[i + 1:j + 1]])
+            self.runs[(i, j)] = self.train.section_run_time(d_mi, v_max_mph, t_dwell=0)
+        return self.runs[(i, j)]
+
+    def pattern_times(self, stop_mask):
+        '''
+        Returns the arrival-to-arrival time (s) at each stop served by a stopping pattern,
+        as in a timetable's 'time (min)' column (dwell at the previous served stop included);
+        NaN at skipped stops, 0 at the first stop
+        stop_mask = array of bools, one per stop; must serve both termini
+        '''
+        stop_mask = np.asarray(stop_mask, dtype=bool)
+        assert len(stop_mask) == len(self.stops), \
+            "Stop mask must have one entry per stop!"
+        assert all([stop_mask[0], stop_mask[-1]]), \
+            "Stop mask must serve the first and last stops!"
+        served = np.flatnonzero(stop_mask)
+        times = np.full(len(self.stops), np.nan)
+        times[0] = 0
+        for i, j in zip(served[:-1], served[1:]):
+            t_run = self.run_time(i, j)
+            assert t_run > 0, \
+                f"Travel time cannot be calculated from stop {self.stops[i]} to {self.stops[j]}! Check 'track speed (mph)' against the train's params!"
+            times[j] = t_run + self.t_dwell
+        return times
+
+    def evaluate(self, patterns):
+        '''
+        Returns a timetable dataframe for several stopping patterns:
+        'arrival stop', then per pattern, '<name> time (min)' (as pattern_times) and
+        '<name> arrival (min)' (cumulative from the first stop; NaN at skipped stops)
+        patterns = {name: stop mask}
+        '''
+        pattern_df = pd.DataFrame({'arrival stop': self.stops})
+        for name, stop_mask in patterns.items():
+            times = self.pattern_times(stop_mask) / 60
+            pattern_df[f"{name} time (min)"] = times
+            pattern_df[f"{name} arrival (min)"] = np.where(np.isnan(times), np.nan, np.nancumsum(times))
+        return pattern_df
+
+def load_patterns(patterns_csv, n_stops):
+    '''
+    Loads a .csv file of stopping patterns: one row per route stop, in route order,
+    and one column of 1 (stop) / 0 (pass) per pattern; an 'arrival stop' column is ignored
+    Returns {name: stop mask}
+    '''
+    patterns_df = pd.read_csv(patterns_csv)
+    assert len(patterns_df) == n_stops, \
+        "Patterns .csv must have one row per route stop!"
+    return {name: patterns_df[name].to_numpy(dtype=bool)
+            for name in patterns_df.columns if name != 'arrival stop'}
+
+if __name__ == "__main__":
+    '''
+    Command line interface
+    Calculates timetables of several stopping patterns of a train on a route
+    Sample usage: patterns.py -t sample_train_A.json -r sample_route_A.csv -p sample_route_A_patterns.csv
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--trainfile", required=True, help=".json file representing a train consist")
+    parser.add_argument("-r", "--routefile", required=True, help=".csv file representing a route")
+    parser.add_argument("-p", "--patternfile", required=True, help=".csv file of stopping patterns, one 1/0 column per pattern")
+    parser.add_argument("-d", "--dwelltime", required=False, default=120, type=float, help="(optional) dwell/buffer time at each stop served in seconds")
+    parser.add_argument("-O", "--outfile", required=False, default=None, help="(optional) output .csv path (default: <routefile>_patterns_timetable.csv)")
+    args = parser.parse_args()
+
+    assert args.dwelltime >= 0, \
+        "--dwelltime must be a nonnegative number!"
+
+    route_df = load_route(args.routefile)
+    engine = PatternEngine(load_train(args.trainfile), route_df, args.dwelltime)
+    pattern_df = engine.evaluate(load_patterns(args.patternfile, len(route_df)))
+    out_csv = args.outfile if args.outfile is not None else args.routefile[0:-4] + '_patterns_timetable.csv'
+    pattern_df.to_csv(out_csv, index=False)
+    print(f"{len(engine.runs)} distinct runs calculated; timetable written to {out_csv}")
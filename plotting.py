@@ -0,0 +1,130 @@
+from CTrain import *
+from timetable import *
+from trajectory import Trajectory
+import argparse
+
+def sample_vel_curve(train, v_max_mph, accel=True, n_points=1000):
+    '''
+    Returns (t (s), v (mph)) at n_points evenly-spaced times along a Train's
+    acceleration up to v_max_mph (accel=True), or braking down from it (accel=False),
+    in one vectorized call
+    '''
+    assert v_max_mph > 0, \
+        "The following args must be positive: v_max_mph"
+    if accel:
+        t = np.linspace(0, train.calc_accel_time(v_max_mph), n_points)
+        v = train.calc_accel_vel(t)
+    else:
+        t = np.linspace(0, train.calc_brake_time(v_max_mph), n_points)
+        v = train.calc_brake_vel(t, v_max_mph)
+    return t, np.asarray(v) / MPH_TO_M_S
+
+def sample_route_curve(trajectory, n_points=20000):
+    '''
+    Returns (milepost (mi), v (mph)) along a Trajectory, at n_points evenly-spaced times
+    plus every phase boundary, so corners are drawn exactly
+    '''
+    t = np.union1d(np.linspace(0, trajectory.t_total, n_points), trajectory.t_start)
+    return trajectory.state_at(t)
+
+class SpeedPlotter():
+    def __init__(self, width_in=10, height_in=6, dpi=100):
+        '''
+        Headless plotter of speed curves: draws on one reused Agg figure (never pyplot,
+        so no display and no global figure state), and writes each plot to a file
+        width_in, height_in, dpi (optional) = figure size (in) and resolution
+        '''
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.fig = Figure(figsize=(width_in, height_in), dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+
+    def _start(self, title, xlabel):
+        self.ax.cla()
+        self.ax.grid(linestyle='dotted')
+        self.ax.set_title(title)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel('Speed (mph)')
+
+    def _save(self, out_path):
+        '''Writes the figure to out_path; the format (eg. .png, .svg) follows its extension'''
+        if self.ax.get_legend_handles_labels()[0]:
+            self.ax.legend(loc='best', fontsize='small')
+        self.fig.savefig(out_path)
+        return out_path
+
+    def plot_vel_curves(self, trains, v_max_mph, out_path, phases=("accel", "brake"), n_points=1000):
+        '''
+        Overlays speed vs time curves of many trains on shared axes, and writes them to out_path
+        trains = {label: Train (or TrainProfile)}
+        phases (optional) = any of "accel" (up to v_max_mph) and "brake" (down from v_max_mph)
+        '''
+        assert all(phase in ("accel", "brake") for phase in phases), \
+            "phases must each be one of: 'accel', 'brake'"
+        self._start(" and ".join("Acceleration" if phase == "accel" else "Braking" for phase in phases).capitalize(),
+                    'Time (s)')
+        for label, train in trains.items():
+            for phase in phases:
+                t, v_mph = sample_vel_curve(train, v_max_mph, accel=(phase == "accel"), n_points=n_points)
+                self.ax.plot(t, v_mph, label=f"{label} ({phase})" if len(phases) > 1 else label,
+                             linestyle='-' if phase == "accel" else '--')
+        return self._save(out_path)
+
+    def plot_route(self, trains, route_df, out_path, t_dwell=120, n_points=20000):
+        '''
+        Overlays speed vs distance diagrams of many trains over one route (stopping at every stop),
+        with the track speed limits, and writes them to out_path
+        trains = {label: Train (or TrainProfile)}
+        '''
+        self._start('Speed vs distance', 'Distance (mi)')
+        _, d_mi, v_limit_mph = route_segments(route_df)
+        x_stop_mi = np.concatenate([[0], np.cumsum(d_mi)])
+        self.ax.step(x_stop_mi, np.concatenate([v_limit_mph[:1], v_limit_mph]),
+                     where='pre', color='gray', linewidth=1, label='track speed')
+        for label, train in trains.items():
+            x_mi, v_mph = sample_route_curve(Trajectory(train, route_df, t_dwell), n_points)
+            self.ax.plot(x_mi, v_mph, label=label)
+        return self._save(out_path)
+
+if __name__ == "__main__":
+    '''
+    Command line interface
+    Writes speed curve plots of many trains: per train, and all trains overlaid
+    Sample usage: plotting.py -T "trains/*.json" -V 125 -r sample_route_A.csv -o plots -f svg
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-T", "--trainfiles", required=True, nargs="+", help="globs or directories of train consist .json files")
+    parser.add_argument("-V", "--vmax", required=False, default=None, type=float, help="(optional) plot accel and brake curves up to/down from this speed (mph)")
+    parser.add_argument("-r", "--routefile", required=False, default=None, help="(optional) plot speed vs distance diagrams over this route .csv")
+    parser.add_argument("-d", "--dwelltime", required=False, default=120, type=float, help="(optional) dwell/buffer time at each stop in seconds")
+    parser.add_argument("-o", "--outdir", required=False, default="plots", help="(optional) directory to write plots to")
+    parser.add_argument("-f", "--format", required=False, default="png", choices=["png", "svg", "pdf"], help="(optional) plot file format")
+    args = parser.parse_args()
+
+    assert any([args.vmax, args.routefile]), \
+        "Pass --vmax and/or --routefile to plot!"
+    assert args.vmax is None or args.vmax > 0, \
+        "--vmax must be a positive number!"
+    train_jsons = expand_paths(args.trainfiles, ".json")
+    assert train_jsons, \
+        "--trainfiles must match at least one file!"
+
+    registry = ConsistRegistry()
+    trains = {os.path.splitext(os.path.basename(train_json))[0]: registry.get(train_json) for train_json in train_jsons}
+    route_df = load_route(args.routefile) if args.routefile is not None else None
+    os.makedirs(args.outdir, exist_ok=True)
+    plotter = SpeedPlotter()
+    n_plots = 0
+    groups = [(name, {name: train}) for name, train in trains.items()]
+    if len(trains) > 1:
+        groups.append(("overlay", trains))
+    for name, group in groups:
+        if args.vmax is not None:
+            plotter.plot_vel_curves(group, args.vmax, os.path.join(args.outdir, f"{name}_curves.{args.format}"))
+            n_plots += 1
+        if route_df is not None:
+            plotter.plot_route(group, route_df, os.path.join(args.outdir, f"{name}_route.{args.format}"), args.dwelltime)
+            n_plots += 1
+    print(f"{n_plots} plots written to {args.outdir}")
@@ -0,0 +1,216 @@
+from CTrain import *
+from timetable import *
+import argparse
+import json
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+def _draw_fixed(rng, mean, sd, size):
+    return np.full(size, float(mean))
+
+def _draw_normal(rng, mean, sd, size):
+    # dwell cannot be negative
+    return np.maximum(rng.normal(mean, sd, size), 0)
+
+def _draw_lognormal(rng, mean, sd, size):
+    # underlying normal's params, from the lognormal's mean and sd
+    sigma2 = np.log(1 + (sd / mean)**2)
+    return rng.lognormal(np.log(mean) - sigma2 / 2, np.sqrt(sigma2), size)
+
+def _draw_gamma(rng, mean, sd, size):
+    return rng.gamma((mean / sd)**2, sd**2 / mean, size)
+
+def _draw_uniform(rng, mean, sd, size):
+    half_width = sd * np.sqrt(3)
+    return rng.uniform(max(mean - half_width, 0), mean + half_width, size)
+
+### dwell time distributions, each parameterized by its mean and sd (s) ###
+DWELL_DISTS = {"fixed": _draw_fixed,
+               "normal": _draw_normal,
+               "lognormal": _draw_lognormal,
+               "gamma": _draw_gamma,
+               "uniform": _draw_uniform}
+
+### Train args that can be perturbed (relative sd); brake_a scales both braking rates ###
+PERTURB_PARAMS = ("m_lb", "P_hp", "F_lbf", "brake_a")
+
+def _simulate_chunk(runs, dwell, dwell_mean, dwell_sd, n_reps, seed_seq):
+    '''
+    Returns replications x stops arrival times (s) of n_reps replications, drawn from seed_seq
+    runs = consists x segments run times (s), without dwell; each replication draws one consist
+    '''
+    rng = np.random.default_rng(seed_seq)
+    n_segs = runs.shape[1]
+    # dwell at each segment's departure stop, before running it
+    dwells = DWELL_DISTS[dwell](rng, dwell_mean, dwell_sd, (n_reps, n_segs))
+    consists = rng.integers(len(runs), size=n_reps)
+    arrivals = np.zeros((n_reps, n_segs + 1))
+    np.cumsum(dwells + runs[consists], axis=1, out=arrivals[:, 1:])
+    return arrivals
+
+# per-worker-process sim args (run times, dwell distribution), set once by _init_worker
+_worker_args = None
+
+def _init_worker(runs, dwell, dwell_mean, dwell_sd):
+    global _worker_args
+    _worker_args = (runs, dwell, dwell_mean, dwell_sd)
+
+def _simulate_worker_chunk(n_reps, seed_seq):
+    return _simulate_chunk(*_worker_args, n_reps, seed_seq)
+
+class PunctualitySim():
+    def __init__(self, params, route_df, dwell="lognormal", dwell_mean=120, dwell_sd=30, perturb=None, n_consists=1000, seed=0):
+        '''
+        Monte Carlo punctuality of one train over one route, stopping at every stop:
+        dwell times are drawn per stop and replication, and optionally the train's performance per replication
+        params = Train args (dict, eg. from parse_train)
+        route_df = route dataframe (load_route)
+        dwell (optional) = dwell time distribution, one of DWELL_DISTS, with mean dwell_mean and sd dwell_sd (s)
+        perturb (optional) = {Train arg (one of PERTURB_PARAMS): relative sd}, eg. {"m_lb": 0.05};
+          each is drawn normally, truncated to +/- 3 sd
+        n_consists (optional) = number of perturbed consists to draw, if perturb
+        seed (optional) = seed of every random draw, so runs are reproducible
+
+        Segment run times (without dwell) are calculated once, for the nominal consist and each
+        perturbed consist (one TrainBatch call); replications then only draw dwell times and a consist,
+        and add up precomputed run times, as array operations
+        '''
+        assert dwell in DWELL_DISTS, \
+            f"dwell must be one of: {', '.join(DWELL_DISTS)}"
+        assert dwell_mean > 0 and (dwell == "fixed" or dwell_sd > 0), \
+            "The following args must be positive: dwell_mean, dwell_sd"
+        perturb = perturb or {}
+        assert all(param in PERTURB_PARAMS for param in perturb), \
+            f"perturb args must each be one of: {', '.join(PERTURB_PARAMS)}"
+        assert all(sd >= 0 for sd in perturb.values()), \
+            "perturb sds must be nonnegative numbers!"
+        self.route_df = route_df
+        # departure stop, then every segment's arrival stop; on loop routes, the first row is a segment too
+        self.stops = segment_stops(route_df)
+        self.dwell = dwell
+        self.dwell_mean = dwell_mean
+        self.dwell_sd = dwell_sd
+        # seeds: one for consists, then one per chunk of replications
+        self.seed_seq = np.random.SeedSequence(seed)
+        consist_seed, self.chunk_seed = self.seed_seq.spawn(2)
+
+        # run times are per segment, at its track speed, for every perturbed consist at once (TrainBatch)
+        check_unrestricted(route_df, "PunctualitySim")
+        _, d_mi, v_max_mph = route_segments(route_df)
+        assert len(d_mi) > 0, \
+            "Route must have at least two stops!"
+
+        # nominal run times, and the nominal schedule: arrivals (s) at every stop with mean dwell
+        self.run_nominal = np.atleast_1d(Train(**params).stop_to_stop_times(d_mi, v_max_mph, 0)[0])
+        assert np.all(self.run_nominal > 0), \
+            "Travel time cannot be calculated for every segment! Check 'track speed (mph)' against the train's params!"
+        self.schedule = np.concatenate([[0], np.cumsum(self.run_nominal + dwell_mean)])
+
+        # consists x segments run times (s), row 0 nominal
+        if perturb:
+            rng = np.random.default_rng(consist_seed)
+            batch_params = {param: np.full(n_consists, float(value)) for param, value in params.items()}
+            for param, sd in perturb.items():
+                scale = 1 + sd * np.clip(rng.standard_normal(n_consists), -3, 3)
+                if param == "brake_a":
+                    batch_params["brake_a1_mphps"] = batch_params["brake_a1_mphps"] * scale
+                    batch_params["brake_a2_mphps"] = batch_params["brake_a2_mphps"] * scale
+                else:
+                    batch_params[param] = batch_params[param] * scale
+            runs = TrainBatch(**batch_params).stop_to_stop_times(d_mi, v_max_mph, 0)[0]
+            assert np.all(runs > 0), \
+                f"Travel time cannot be calculated for {int(np.sum(np.any(runs <= 0, axis=1)))} perturbed consist(s)! Reduce the perturbation"
+            self.runs = runs
+        else:
+            self.runs = self.run_nominal[None, :]
+
+    def simulate_chunk(self, n_reps, seed_seq):
+        '''Returns replications x stops arrival times (s) of n_reps replications, drawn from seed_seq'''
+        return _simulate_chunk(self.runs, self.dwell, self.dwell_mean, self.dwell_sd, n_reps, seed_seq)
+
+    def chunk_seeds(self, n_chunks):
+        '''Returns the seeds of the first n_chunks chunks: the i-th child of the sim's chunk seed, without spawning (which is stateful)'''
+        return [np.random.SeedSequence(self.chunk_seed.entropy, spawn_key=self.chunk_seed.spawn_key + (i,))
+                for i in range(n_chunks)]
+
+    def simulate(self, n_reps=10000, chunksize=10000, workers=1):
+        '''
+        Returns replications x stops arrival times (s), time 0 being arrival at the first stop
+        Replications run in chunks of chunksize, each with its own seed (derived from the sim's seed),
+        so results depend only on seed and chunksize: not on workers, nor on earlier calls
+        workers (optional) = number of worker processes; None for one per CPU
+        '''
+        assert all([n_reps > 0, chunksize > 0]), \
+            "The following args must be positive: n_reps, chunksize"
+        sizes = [min(chunksize, n_reps - start) for start in range(0, n_reps, chunksize)]
+        seeds = self.chunk_seeds(len(sizes))
+        if workers == 1 or len(sizes) == 1:
+            chunks = [self.simulate_chunk(size, seed) for size, seed in zip(sizes, seeds)]
+        else:
+            # workers get the run times once, not with every chunk
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self.runs, self.dwell, self.dwell_mean, self.dwell_sd)) as executor:
+                chunks = list(executor.map(_simulate_worker_chunk, sizes, seeds))
+        return np.concatenate(chunks)
+
+    def summarize(self, arrivals, percentiles=(50, 90, 95, 99), late_min=(0, 1, 3, 5)):
+        '''
+        Returns the punctuality dataframe: per stop, the scheduled arrival (nominal run times and mean dwell),
+        the arrival at each percentile, and the probability of arriving within each of late_min (min)
+        of schedule, in min
+        '''
+        punctuality_df = pd.DataFrame({'arrival stop': self.stops,
+                                       'scheduled (min)': self.schedule / 60,
+                                       'mean (min)': arrivals.mean(axis=0) / 60})
+        for p, values in zip(percentiles, np.percentile(arrivals, percentiles, axis=0)):
+            punctuality_df[f'p{p:g} (min)'] = values / 60
+        for late in late_min:
+            punctuality_df[f'on time +{late:g} min'] = np.mean(arrivals <= self.schedule + late * 60, axis=0)
+        return punctuality_df
+
+def simulate_punctuality(train_json, route_csv, n_reps=10000, workers=1, **kwargs):
+    '''
+    Wrapper:
+    As PunctualitySim (kwargs), for a train consist .json file and route .csv file
+    Returns the punctuality dataframe (PunctualitySim.summarize) of n_reps replications
+    '''
+    with open(train_json) as j_file:
+        params = parse_train(json.load(j_file))
+    sim = PunctualitySim(params, load_route(route_csv), **kwargs)
+    return sim.summarize(sim.simulate(n_reps, workers=workers))
+
+if __name__ == "__main__":
+    '''
+    Command line interface
+    Simulates a train's punctuality over a route, with random dwell times and train performance
+    Sample usage: punctuality.py -t sample_train_A.json -r sample_route_A.csv -n 50000 --dwellsd 30 --perturb m_lb=0.05 P_hp=0.03
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--trainfile", required=True, help=".json file representing a train consist")
+    parser.add_argument("-r", "--routefile", required=True, help=".csv file representing a route")
+    parser.add_argument("-n", "--reps", required=False, default=10000, type=int, help="(optional) number of replications")
+    parser.add_argument("-d", "--dwelltime", required=False, default=120, type=float, help="(optional) mean dwell/buffer time at each stop in seconds")
+    parser.add_argument("--dwellsd", required=False, default=30, type=float, help="(optional) sd of dwell time in seconds")
+    parser.add_argument("--dwelldist", required=False, default="lognormal", choices=list(DWELL_DISTS), help="(optional) dwell time distribution")
+    parser.add_argument("--perturb", required=False, default=[], nargs="+", help=f"(optional) relative sds of train args, as ARG=SD; ARG one of {', '.join(PERTURB_PARAMS)}")
+    parser.add_argument("--seed", required=False, default=0, type=int, help="(optional) random seed")
+    parser.add_argument("-w", "--workers", required=False, default=1, type=int, help="(optional) number of worker processes")
+    parser.add_argument("-O", "--outfile", required=False, default=None, help="(optional) output .csv path (default: <routefile>_punctuality.csv)")
+    args = parser.parse_args()
+
+    assert all([args.reps > 0, args.workers > 0]), \
+        "--reps and --workers must be positive numbers!"
+    perturb = {}
+    for item in args.perturb:
+        param, _, sd = item.partition("=")
+        perturb[param] = float(sd)
+
+    punctuality_df = simulate_punctuality(args.trainfile, args.routefile, args.reps, args.workers,
+                                          dwell=args.dwelldist, dwell_mean=args.dwelltime, dwell_sd=args.dwellsd,
+                                          perturb=perturb, seed=args.seed)
+    out_csv = args.outfile if args.outfile is not None else args.routefile[0:-4] + '_punctuality.csv'
+    punctuality_df.to_csv(out_csv, index=False)
+    print(punctuality_df.to_string(index=False))
+    print(f"{args.reps} replications; punctuality written to {out_csv}")
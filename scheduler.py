@@ -0,0 +1,226 @@
+from CTrain import *
+from timetable import *
+from trajectory import Trajectory
+import argparse
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+def parse_clock(clock):
+    '''Returns seconds after midnight of a "HH:MM" or "HH:MM:SS" string, or of a number of seconds'''
+    if isinstance(clock, str) and ":" in clock:
+        fields = [float(field) for field in clock.split(":")]
+        assert len(fields) in (2, 3), \
+            f"Times must be HH:MM or HH:MM:SS, got {clock}"
+        return fields[0] * 3600 + fields[1] * 60 + (fields[2] if len(fields) == 3 else 0)
+    return float(clock)
+
+def clock_str(t):
+    '''Returns "HH:MM:SS" of t (s after midnight), rounded to the second'''
+    t = int(round(t))
+    return f"{t // 3600:02d}:{t % 3600 // 60:02d}:{t % 60:02d}"
+
+def load_services(services_csv):
+    '''
+    Loads a .csv file of services: one row per train-run, with columns
+    'service' (name), 'train' (consist .json path), 'route' (route .csv path),
+    'departure' (from the route's first stop; HH:MM[:SS] or s after midnight)
+    Train and route paths are relative to the .csv file's directory
+    Returns services dataframe, with 'departure (s)'
+    '''
+    services_df = pd.read_csv(services_csv, dtype={'departure': str})
+    assert all(column in services_df for column in ('service', 'train', 'route', 'departure')), \
+        "Services .csv must have columns: service, train, route, departure"
+    assert services_df['service'].is_unique, \
+        "Service names must be unique!"
+    base_dir = os.path.dirname(services_csv)
+    for column in ('train', 'route'):
+        services_df[column] = [os.path.join(base_dir, path) for path in services_df[column]]
+    services_df['departure (s)'] = [parse_clock(clock) for clock in services_df['departure']]
+    return services_df
+
+class LineScheduler():
+    def __init__(self, services_df, t_dwell=120, headway=120, block_mi=None, cache_dir=None):
+        '''
+        Schedules many train-runs over shared track, and finds where they conflict
+        services_df = services dataframe (load_services)
+        t_dwell (optional) = dwell/buffer time at each stop (s)
+        headway (optional) = min time (s) between one train leaving a block and the next entering it
+        block_mi (optional) = split each stop-to-stop segment into equal blocks of at most block_mi (mi);
+          default one block per segment
+        cache_dir (optional) = as gen_timetable
+
+        Blocks are identified by (from stop, to stop, block number), so routes sharing a pair of
+        consecutive stops share its blocks, per direction. Each distinct (train, route) run is
+        calculated once (Trajectory), then shifted to every service's departure
+        '''
+        assert headway >= 0, \
+            "The following args must be nonnegative: headway"
+        assert block_mi is None or block_mi > 0, \
+            "The following args must be positive: block_mi"
+        self.services_df = services_df.reset_index(drop=True)
+        self.t_dwell = t_dwell
+        self.headway = headway
+        self.block_mi = block_mi
+        self.cache_dir = cache_dir
+        self.registry = ConsistRegistry()
+        # (train, route) => block codes, entry and exit times (s) from departure
+        self.runs = {}
+        # block name (from stop, to stop, block number) => block code, and back
+        self.block_codes = {}
+        self.block_names = []
+        self.calc_occupancy()
+
+    def calc_run(self, train_json, route_csv):
+        '''Returns (block codes, entry times, exit times (s, from departure)) of one train on one route'''
+        if (train_json, route_csv) not in self.runs:
+            train = self.registry.get(train_json)
+            route_df = load_route(route_csv)
+            trajectory = Trajectory(TrainProfile(train, cache_dir=self.cache_dir), route_df, self.t_dwell)
+            stops = trajectory.stops
+            d_mi = route_segments(route_df)[1]
+            n_blocks = np.ones(len(d_mi), dtype=int) if self.block_mi is None \
+                else np.maximum(1, np.ceil(d_mi / self.block_mi - 1e-9).astype(int))
+            seg = np.repeat(np.arange(len(d_mi)), n_blocks)
+            part = np.arange(len(seg)) - np.repeat(np.cumsum(n_blocks) - n_blocks, n_blocks)
+            x_start = trajectory.x_stop_mi[seg] + d_mi[seg] * part / n_blocks[seg]
+            x_end = trajectory.x_stop_mi[seg] + d_mi[seg] * (part + 1) / n_blocks[seg]
+            # leaving a stop: departure, not arrival; reaching the next: departure after its dwell,
+            # so the train holds the block it stops at, except at the last stop
+            last_seg = len(d_mi) - 1
+            t_enter = np.where(part == 0, trajectory.t_arrival[seg] + self.t_dwell, trajectory.time_at(x_start))
+            t_exit = np.where(part == n_blocks[seg] - 1,
+                              trajectory.t_arrival[seg + 1] + np.where(seg < last_seg, self.t_dwell, 0),
+                              trajectory.time_at(x_end))
+            codes = []
+            for i, j in zip(seg, part):
+                name = (stops[i], stops[i + 1], int(j))
+                if name not in self.block_codes:
+                    self.block_codes[name] = len(self.block_names)
+                    self.block_names.append(name)
+                codes.append(self.block_codes[name])
+            # times from departure, which is t_dwell after arrival at the first stop
+            self.runs[(train_json, route_csv)] = (np.array(codes, dtype=int), t_enter - self.t_dwell, t_exit - self.t_dwell)
+        return self.runs[(train_json, route_csv)]
+
+    def calc_occupancy(self):
+        '''
+        Builds the occupancy table: one entry per (service, block), with entry and exit times (s)
+        Service departures may be changed (eg. retimed) and this run again; runs are not recalculated
+        '''
+        departures = self.services_df['departure (s)'].to_numpy(dtype=float)
+        service, block, t_enter, t_exit = [], [], [], []
+        # every service of one (train, route) run is the same run, shifted
+        for (train_json, route_csv), idx in self.services_df.groupby(['train', 'route'], sort=False).indices.items():
+            codes, run_enter, run_exit = self.calc_run(train_json, route_csv)
+            service.append(np.repeat(idx, len(codes)))
+            block.append(np.tile(codes, len(idx)))
+            t_enter.append((departures[idx, None] + run_enter[None, :]).ravel())
+            t_exit.append((departures[idx, None] + run_exit[None, :]).ravel())
+        self.occupancy = {'service': np.concatenate(service), 'block': np.concatenate(block),
+                          't_enter': np.concatenate(t_enter), 't_exit': np.concatenate(t_exit)}
+
+    def _sweep(self):
+        '''
+        Sorted sweep: occupancies are sorted by (block, entry); within a block, each entry is checked
+        against the latest clearance (exit + headway) of all earlier entries, in O(n log n)
+        Returns occupancy indices (later, earlier) of each conflict, and when the block clears (s)
+        '''
+        occ = self.occupancy
+        order = np.lexsort((occ['t_enter'], occ['block']))
+        if len(order) == 0:
+            return order, order, np.zeros(0)
+        block = occ['block'][order]
+        t_enter = occ['t_enter'][order]
+        t_clear = occ['t_exit'][order] + self.headway
+        # offset each block's times past all earlier blocks', so one running max covers every block
+        t_min = min(t_enter.min(), t_clear.min())
+        offset = block * (max(t_enter.max(), t_clear.max()) - t_min + 1) - t_min
+        clear_off = t_clear + offset
+        running = np.maximum.accumulate(clear_off)
+        # index of the occupancy holding the running max clearance
+        holder = np.maximum.accumulate(np.where(clear_off >= running, np.arange(len(order)), 0))
+        conflict = np.concatenate([[False], running[:-1] > (t_enter + offset)[1:]])
+        i_later = np.flatnonzero(conflict)
+        return order[i_later], order[holder[i_later - 1]], running[i_later - 1] - offset[i_later]
+
+    def find_conflicts(self):
+        '''
+        Returns the conflicts dataframe: one row per block entry made before the block was
+        cleared (+ headway) by an earlier-entering service, with both services, the later one's
+        entry and the block's clearance (s after midnight), and the shortfall (s) between them
+        '''
+        i_later, i_earlier, t_clear = self._sweep()
+        occ = self.occupancy
+        names = self.services_df['service'].to_numpy()
+        blocks = [self.block_names[b] for b in occ['block'][i_later]]
+        return pd.DataFrame({'from stop': [b[0] for b in blocks],
+                             'to stop': [b[1] for b in blocks],
+                             'block': [b[2] for b in blocks],
+                             'earlier service': names[occ['service'][i_earlier]],
+                             'later service': names[occ['service'][i_later]],
+                             'later entry (s)': occ['t_enter'][i_later],
+                             'block clear (s)': t_clear,
+                             'shortfall (s)': t_clear - occ['t_enter'][i_later]})
+
+    def suggest_retiming(self, max_rounds=100):
+        '''
+        Returns the retiming dataframe: each service's departure, and the delay (s) and new departure
+        that clear every conflict, found greedily: in each round, every service entering a block
+        too early is delayed by its largest shortfall, then conflicts are found again
+        Services are never moved earlier, so the first service on each block keeps its time
+        '''
+        departures = self.services_df['departure (s)'].to_numpy(dtype=float).copy()
+        delays = np.zeros(len(departures))
+        try:
+            for _ in range(max_rounds):
+                i_later, _, t_clear = self._sweep()
+                if len(i_later) == 0:
+                    break
+                shortfall = np.zeros(len(departures))
+                np.maximum.at(shortfall, self.occupancy['service'][i_later], t_clear - self.occupancy['t_enter'][i_later])
+                delays += shortfall
+                self.services_df['departure (s)'] = departures + delays
+                self.calc_occupancy()
+            else:
+                logger.warning(f"Conflicts remain after {max_rounds} retiming rounds")
+        finally:
+            # leave the schedule as given
+            self.services_df['departure (s)'] = departures
+            self.calc_occupancy()
+        return pd.DataFrame({'service': self.services_df['service'],
+                             'departure': [clock_str(t) for t in departures],
+                             'delay (s)': delays,
+                             'new departure': [clock_str(t) for t in departures + delays]})
+
+if __name__ == "__main__":
+    '''
+    Command line interface
+    Finds block-occupancy conflicts between services on shared track, and suggests retiming
+    Sample usage: scheduler.py -s sample_services.csv -H 120 -o schedule
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--servicefile", required=True, help=".csv file of services: service, train, route, departure")
+    parser.add_argument("-d", "--dwelltime", required=False, default=120, type=float, help="(optional) dwell/buffer time at each stop in seconds")
+    parser.add_argument("-H", "--headway", required=False, default=120, type=float, help="(optional) min time in seconds between one train clearing a block and the next entering it")
+    parser.add_argument("-b", "--blocklength", required=False, default=None, type=float, help="(optional) max block length in miles (default: one block per stop-to-stop segment)")
+    parser.add_argument("-c", "--cachedir", required=False, default=".trainprofiles", help="(optional) directory to cache precomputed train speed-profile tables in")
+    parser.add_argument("-o", "--outdir", required=False, default="schedule", help="(optional) directory to write conflicts.csv and retiming.csv to")
+    args = parser.parse_args()
+
+    assert all([args.dwelltime >= 0, args.headway >= 0]), \
+        "--dwelltime and --headway must be nonnegative numbers!"
+
+    scheduler = LineScheduler(load_services(args.servicefile), args.dwelltime, args.headway, args.blocklength, args.cachedir)
+    conflicts_df = scheduler.find_conflicts()
+    retiming_df = scheduler.suggest_retiming()
+    os.makedirs(args.outdir, exist_ok=True)
+    conflicts_df.to_csv(os.path.join(args.outdir, 'conflicts.csv'), index=False)
+    retiming_df.to_csv(os.path.join(args.outdir, 'retiming.csv'), index=False)
+    print(f"{len(scheduler.services_df)} services, {len(scheduler.runs)} distinct runs, {len(conflicts_df)} conflicts; "
+          f"{int(np.sum(retiming_df['delay (s)'] > 0))} services retimed")
+    print(f"Conflicts and retiming written to {args.outdir}")
@@ -0,0 +1,158 @@
+from CTrain import *
+from timetable import *
+import argparse
+import json
+import logging
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+class QueryState():
+    def __init__(self, cache_dir=None, maxsize=256):
+        '''
+        Warm state shared by all requests: parsed consists (ConsistRegistry),
+        and each consist's speed-profile tables (TrainProfile), if cache_dir
+        cache_dir (optional) = as gen_timetable; None to compute every query exactly
+        maxsize (optional) = max number of consists kept
+        '''
+        self.cache_dir = cache_dir
+        self.registry = ConsistRegistry(maxsize=maxsize)
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+    def get_train(self, train_json):
+        '''Returns the (warm) Train, or TrainProfile if cache_dir, of a train consist .json file'''
+        with self.lock:
+            train = self.registry.get(train_json)
+            if self.cache_dir is None:
+                return train
+            if train not in self.profiles:
+                # drop tables of consists the registry evicted or reloaded
+                live = set(entry['train'] for entry in self.registry.entries.values())
+                self.profiles = {t: p for t, p in self.profiles.items() if t in live}
+                self.profiles[train] = TrainProfile(train, cache_dir=self.cache_dir)
+            return self.profiles[train]
+
+    def stop_to_stop(self, query):
+        '''
+        Stop-to-stop query:
+        train = train consist .json path; dist = stop-to-stop dist (mi), speed = max speed (mph),
+        either numbers or equal-length lists; dwell (optional) = dwell time (s), default 120
+        Returns time (s), peak speed (mph) and avg speed (mph), each a number or list as dist; -1 if invalid
+        '''
+        train = self.get_train(query["train"])
+        t_total, v_peak, v_avg = train.stop_to_stop_times(query["dist"], query["speed"], float(query.get("dwell", 120)))
+        return {"time (s)": np.asarray(t_total).tolist(),
+                "peak spd (mph)": np.asarray(v_peak).tolist(),
+                "avg spd (mph)": np.asarray(v_avg).tolist()}
+
+    def brake(self, query):
+        '''
+        Braking query:
+        train = train consist .json path; speed = initial speed (mph), a number or list
+        Returns time (s) and dist (mi) to stop, each a number or list as speed
+        '''
+        train = self.get_train(query["train"])
+        return {"time (s)": np.asarray(train.calc_brake_time(query["speed"])).tolist(),
+                "dist (mi)": (np.asarray(train.calc_brake_dist(query["speed"])) / MI_TO_M).tolist()}
+
+    def timetable(self, query):
+        '''
+        Timetable query:
+        train = train consist .json path; route = route .csv path; dwell (optional) = dwell time (s), default 120
+        Returns the timetable rows, as a list of {column: value}
+        '''
+        train = self.get_train(query["train"])
+        route_df = calc_timetable(train, load_route(query["route"]), float(query.get("dwell", 120)))
+        # empty cells (eg. of 'restrictions') are NaN, which is not JSON: null instead
+        return route_df.astype(object).where(route_df.notnull(), None).to_dict(orient="records")
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    Answers GET (query string) or POST (JSON object body) queries on
+    /stop_to_stop, /brake and /timetable (see QueryState) with a JSON object;
+    errors in the query are answered with 400 and {"error": message}
+    '''
+    routes = {"/stop_to_stop": QueryState.stop_to_stop,
+              "/brake": QueryState.brake,
+              "/timetable": QueryState.timetable}
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.answer(url.path, lambda: self.parse_query_string(url.query))
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        self.answer(url.path, self.parse_body)
+
+    def parse_query_string(self, query_string):
+        query = {}
+        for key, value in parse_qsl(query_string):
+            # numbers in query strings may be comma-separated lists
+            query[key] = value if key in ("train", "route") else \
+                ([float(x) for x in value.split(",")] if "," in value else float(value))
+        return query
+
+    def parse_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        return json.loads(body) if body else {}
+
+    def answer(self, path, parse_query):
+        '''Answers the query parse_query() returns, parsed here so malformed queries are answered with 400 too'''
+        if path not in self.routes:
+            return self.send_json(404, {"error": f"Unknown query {path}, expected one of {list(self.routes)}"})
+        try:
+            res = self.routes[path](self.server.state, parse_query())
+        except (AssertionError, KeyError, ValueError, TypeError, OSError) as e:
+            return self.send_json(400, {"error": f"{type(e).__name__}: {e}"})
+        self.send_json(200, res)
+
+    def send_json(self, status, res):
+        body = json.dumps(res).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info("%s " + format, self.address_string(), *args)
+
+def make_server(host="127.0.0.1", port=8642, cache_dir=None):
+    '''Returns a (not yet serving) query server, with its warm state at .state'''
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.daemon_threads = True
+    server.state = QueryState(cache_dir=cache_dir)
+    return server
+
+if __name__ == "__main__":
+    '''
+    Command line interface
+    Runs a local query server that keeps trains and their speed-profile tables loaded
+    Sample usage: server.py -p 8642
+    Then: curl "localhost:8642/stop_to_stop?train=sample_train_A.json&dist=3.2&speed=79"
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-H", "--host", required=False, default="127.0.0.1", help="(optional) address to listen on, default localhost only")
+    parser.add_argument("-p", "--port", required=False, default=8642, type=int, help="(optional) port to listen on")
+    parser.add_argument("-c", "--cachedir", required=False, default=".trainprofiles", help="(optional) directory to cache precomputed train speed-profile tables in")
+    parser.add_argument("--exact", action="store_true", help="(optional) compute every query exactly, instead of from cached speed-profile tables")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="(optional) log every query (-v), and train details (-vv)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
+    logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger("CTrain").setLevel(logging.INFO if args.verbose > 1 else logging.WARNING)
+
+    server = make_server(args.host, args.port, None if args.exact else args.cachedir)
+    print(f"Serving queries on http://{args.host}:{args.port}/ (stop_to_stop, brake, timetable); Ctrl-C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,166 @@
+from CTrain import Train
+from timetable import load_route, parse_restrictions, parse_train, restricted_sections, route_segments
+import argparse
+import json
+import logging
+import numpy as np
+from scipy.optimize import brentq
+
+logger = logging.getLogger(__name__)
+
+### Train args the solver can size, and whether route time falls as the arg grows ###
+SIZING_PARAMS = {"P_hp": True, "F_lbf": True, "m_lb": False}
+
+class RouteTimer():
+    def __init__(self, route_df, t_dwell=120):
+        '''
+        Total route time of any Train over one route, for repeated evaluation while sizing:
+        the route's segments are extracted and deduplicated once, so each evaluation is
+        one batch stop_to_stop_times over the distinct (dist, track speed) segments, plus
+        one batch section_run_times over the segments with speed restrictions (as calc_timetable)
+        route_df = route dataframe (load_route)
+        t_dwell (optional) = dwell/buffer time at each stop (s)
+        '''
+        self.route_df = route_df
+        self.t_dwell = t_dwell
+        # every segment, the first row's too on loop routes (as calc_timetable)
+        rows, d_mi, v_max_mph = route_segments(route_df)
+        r_rows, starts, ends, r_speeds = parse_restrictions(route_df)
+        plain = ~np.isin(rows, r_rows)
+        self.rows = rows[plain]
+        self.segs, inverse, self.counts = np.unique(np.column_stack([d_mi[plain], v_max_mph[plain]]), axis=0,
+                                                    return_inverse=True, return_counts=True)
+        self.inverse = inverse.ravel()
+        # restricted segments, split into sections
+        self.restricted = restricted_sections(route_df['dist (mi)'].to_numpy(dtype=float),
+                                              route_df['track speed (mph)'].to_numpy(dtype=float),
+                                              r_rows, starts, ends, r_speeds) if len(r_rows) > 0 else None
+
+    def seg_times(self, train):
+        '''Returns the stop-to-stop time (s) of each distinct unrestricted segment, -1 where it cannot be calculated'''
+        if len(self.segs) == 0:
+            return np.zeros(0)
+        return np.atleast_1d(train.stop_to_stop_times(self.segs[:, 0], self.segs[:, 1], self.t_dwell)[0])
+
+    def restricted_times(self, train):
+        '''Returns the time (s) of each restricted segment, through its sections, -1 where it cannot be calculated'''
+        if self.restricted is None:
+            return np.zeros(0)
+        _, d_sec, v_sec, run_len = self.restricted
+        return train.section_run_times(d_sec, v_sec, run_len, self.t_dwell)
+
+    def total_time(self, train):
+        '''Returns the total route time (s) of train, or inf if any segment's speed is not reachable'''
+        t_segs = self.seg_times(train)
+        t_restricted = self.restricted_times(train)
+        if np.any(t_segs == -1) or np.any(t_restricted == -1):
+            return np.inf
+        return float(np.dot(t_segs, self.counts) + np.sum(t_restricted))
+
+    def timetable(self, train):
+        '''Returns the route dataframe with 'time (s)', 'arrival (s)' and 'avg spd (mph)' columns'''
+        timetable_df = self.route_df.copy()
+        t_s = np.zeros(len(timetable_df))
+        t_s[self.rows] = self.seg_times(train)[self.inverse]
+        if self.restricted is not None:
+            t_s[self.restricted[0]] = self.restricted_times(train)
+        timetable_df['time (s)'] = t_s
+        timetable_df['arrival (s)'] = np.cumsum(t_s)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            timetable_df['avg spd (mph)'] = np.where(t_s > 0, timetable_df['dist (mi)'] / (t_s / 3600), 0)
+        return timetable_df
+
+def solve_param(params, route_df, t_target_s, param="P_hp", t_dwell=120, rtol=1e-6, max_expansions=30):
+    '''
+    Inverse sizing:
+    Returns (value, timetable dataframe) for the Train arg param (one of SIZING_PARAMS) that makes the
+    total route time exactly t_target_s: the minimum P_hp or F_lbf, or the maximum m_lb, meeting it
+    params = Train args (dict, eg. from parse_train); param's value there starts the bracket
+    route_df = route dataframe (load_route)
+    t_target_s = target total route time (s), dwell included
+    rtol (optional) = relative tolerance on the value
+    max_expansions (optional) = max number of times the bracket is doubled/halved
+
+    Route time is monotone in each of these args, so the root is bracketed by doubling or
+    halving the starting value, then solved with brentq
+    '''
+    assert param in SIZING_PARAMS, \
+        f"param must be one of: {', '.join(SIZING_PARAMS)}"
+    assert t_target_s > 0, \
+        "The following args must be positive: t_target_s"
+    timer = RouteTimer(route_df, t_dwell)
+    falling = SIZING_PARAMS[param]
+
+    def time_err(value):
+        # unreachable speeds (inf) are mapped to a large finite error, so brentq can bisect them
+        return min(timer.total_time(Train(**dict(params, **{param: value}))) - t_target_s, 1e12)
+
+    # bracket the root: grow the value if too slow with more P/F (or too fast with more mass) to add, else shrink it
+    start = float(params[param])
+    too_slow = time_err(start) > 0
+    grow = too_slow == falling
+    lo = hi = start
+    for _ in range(max_expansions):
+        if grow:
+            lo, hi = hi, hi * 2
+            if (time_err(hi) > 0) != too_slow:
+                break
+        else:
+            lo, hi = lo / 2, lo
+            if (time_err(lo) > 0) != too_slow:
+                break
+    else:
+        raise ValueError(f"No {param} between {start} and {hi if grow else lo} meets the target time of {t_target_s} s")
+
+    value = brentq(time_err, lo, hi, rtol=rtol)
+    # round toward the side that meets the target, within the tolerance
+    value = value * (1 + rtol) if falling else value * (1 - rtol)
+    train = Train(**dict(params, **{param: value}))
+    logger.info(f"Sized {param} = {value} for a route time of {timer.total_time(train)} s")
+    return value, timer.timetable(train)
+
+def size_consist(train_json, route_csv, t_target_s, param="P_hp", t_dwell=120):
+    '''
+    Wrapper:
+    As solve_param, for a train consist .json file and route .csv file
+    param may also be "trailer_mass": the maximum total mass (lb) of the consist's trailer cars
+    Returns (value, timetable dataframe)
+    '''
+    with open(train_json) as j_file:
+        train_data = json.load(j_file)
+    params = parse_train(train_data)
+    route_df = load_route(route_csv)
+    if param == "trailer_mass":
+        m_lb_power = sum([power_unit["Mass"] for power_unit in train_data["PowerUnits"]])
+        m_lb, timetable_df = solve_param(params, route_df, t_target_s, "m_lb", t_dwell)
+        assert m_lb > m_lb_power, \
+            f"Target time of {t_target_s} s is not met even without trailer cars!"
+        return m_lb - m_lb_power, timetable_df
+    return solve_param(params, route_df, t_target_s, param, t_dwell)
+
+if __name__ == "__main__":
+    '''
+    Command line interface
+    Sizes a train consist's traction power, tractive effort or trailer mass to meet a target route time
+    Sample usage: sizing.py -t sample_train_A.json -r sample_route_A.csv -T 7200 -p P_hp
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--trainfile", required=True, help=".json file representing a train consist")
+    parser.add_argument("-r", "--routefile", required=True, help=".csv file representing a route")
+    parser.add_argument("-T", "--targettime", required=True, type=float, help="target total route time in seconds, dwell included")
+    parser.add_argument("-p", "--param", required=False, default="P_hp", choices=["P_hp", "F_lbf", "trailer_mass"],
+                        help="(optional) param to size: minimum P_hp or F_lbf, or maximum trailer_mass (lb)")
+    parser.add_argument("-d", "--dwelltime", required=False, default=120, type=float, help="(optional) dwell/buffer time at each stop in seconds")
+    parser.add_argument("-O", "--outfile", required=False, default=None, help="(optional) output .csv path (default: <routefile>_sizing_timetable.csv)")
+    args = parser.parse_args()
+
+    assert args.dwelltime >= 0, \
+        "--dwelltime must be a nonnegative number!"
+
+    value, timetable_df = size_consist(args.trainfile, args.routefile, args.targettime, args.param, args.dwelltime)
+    out_csv = args.outfile if args.outfile is not None else args.routefile[0:-4] + '_sizing_timetable.csv'
+    timetable_df.to_csv(out_csv, index=False)
+    bound = "maximum" if args.param == "trailer_mass" else "minimum"
+    print(f"{bound} {args.param}: {value}")
+    print(f"Route time {timetable_df['arrival (s)'].iloc[-1]} s; timetable written to {out_csv}")
@@ -1,6 +1,10 @@
 from CTrain import *
+import logging
 
 if __name__ == "__main__":
+    # show Train details and stop-to-stop calculations, logged by CTrain
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("CTrain").setLevel(logging.DEBUG)
     D = calc_D(h_in=15*12+7.5, w_in=10*12+3, C_d=0.8)
     print(f"combined coefficient of drag: {D}")
     
@@ -41,6 +45,44 @@ if __name__ == "__main__":
     unrealistic_test_vel = 99999999
     print(f"Expect error -1, got: {train.stop_to_stop_time(d_tot_mi=15, v_max_mph=unrealistic_test_vel)}")
 
-    # expect -1 Error: d_tot_mi is unrealistic; distance is much too short vs. acceleration/deceleration time needed
-    unrealistic_test_dist = 0.01
-    print(f"Expect error -1, got: {train.stop_to_stop_time(d_tot_mi=unrealistic_test_dist, v_max_mph=125)}")
\ No newline at end of file
+    # distance-constrained stop_to_stop_time with a very short distance
+    # expect a valid time: the peak speed is solved for exactly, however far below v_max_mph
+    short_test_dist = 0.01
+    short_test_time, short_test_info = train.stop_to_stop_time(d_tot_mi=short_test_dist, v_max_mph=125, diagnostics=True)
+    print(f"Expect valid time, got: {short_test_time}, peak speed {short_test_info['v_peak_mph']} mph")
+
+    # scheduler: a train dwelling at a stop holds the block it stopped in
+    # expect conflicts: the follower arrives while the leader is still dwelling
+    import pandas as pd
+    from scheduler import LineScheduler
+    dwell_services = pd.DataFrame({'service': ['leader', 'follower'],
+                                   'train': ['sample_train_A.json'] * 2,
+                                   'route': ['sample_route_A.csv'] * 2,
+                                   'departure (s)': [0.0, 100.0]})
+    dwell_conflicts = LineScheduler(dwell_services, t_dwell=120, headway=60, block_mi=0.05).find_conflicts()
+    print(f"Expect conflicts during dwell, got: {len(dwell_conflicts)}")
+
+    # speed restrictions: sections run through one envelope (section_run_times)
+    # expect one section to equal stop_to_stop_time
+    one_section_time = train.section_run_time([10.56], [60])
+    print(f"Expect equal times, got: {one_section_time}, {train.stop_to_stop_time(d_tot_mi=10.56, v_max_mph=60)}")
+
+    # expect a restricted segment to be slower than the unrestricted one
+    restricted_time = train.section_run_time([2, 6, 2.56], [60, 20, 60])
+    print(f"Expect restricted slower, got: {restricted_time} > {one_section_time}")
+
+    # expect a restricted route row to equal its hand-split sections
+    from timetable import load_route, calc_timetable
+    restricted_route = load_route('sample_route_A.csv')
+    restricted_route['restrictions'] = [None] * len(restricted_route)
+    restricted_route.loc[1, 'restrictions'] = "2-8:20"
+    restricted_row_time = calc_timetable(train, restricted_route)['time (min)'][1] * 60
+    print(f"Expect equal times, got: {restricted_row_time}, {restricted_time}")
+
+    # expect ValueError from a malformed restriction
+    restricted_route.loc[1, 'restrictions'] = "2-8"
+    try:
+        calc_timetable(train, restricted_route)
+        print("Expect ValueError, got: no error")
+    except ValueError as e:
+        print(f"Expect ValueError, got: {e}")
@@ -1,84 +1,195 @@
 from CTrain import *
+from CTrain import _load_npz_mmap
 import json
-import pandas as pd
+# pandas is imported where used, to keep importing this module fast
 import argparse
-import time
+import os
+import sys
+import glob
+import logging
+import hashlib
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
-def load_train(train_json):
+logger = logging.getLogger(__name__)
+
+def parse_train(train_data):
     '''
-    Wrapper:
-    loads a .json file representing a train consist
-    See sample .json for format
     Extracts, aggregates necessary performance parameters, dimensions
-    Initializes a Train to be used for performance calculations
+    from a train consist (dict, as loaded from .json; see sample .json for format)
+    Returns the Train args (dict, see TRAIN_PARAMS)
     '''
-    # load json from path
-    j_file = open(train_json)
-    train_data = json.load(j_file)
-    
     ### Extract params at train level ###
     # extract the coefficient of drag
     C_d = train_data["LeadingCoefDrag"]
     # extract braking performance params (optional)
-    brake_params_defined = False
     try:
         brake_a1_mphps = train_data["BrakePerfA1"]
         brake_a2_mphps = train_data["BrakePerfA2"]
         brake_v1_mph = train_data["BrakePerfV1"]
-        brake_params_defined = True
     except KeyError:
-        # case: braking performance params not defined
-        pass
+        # case: braking performance params not defined, default as Train
+        brake_a1_mphps, brake_a2_mphps, brake_v1_mph = BRAKE_A1_MPHPS, BRAKE_A2_MPHPS, BRAKE_V1_MPH
     
     ### Extract params at unit level, aggregate across train level (all units) ###
+    units = train_data["PowerUnits"] + train_data["TrailerCars"]
     # (max) height and width
-    h_in_max = max([power_unit["Height"] for power_unit in train_data["PowerUnits"]] + \
-        [trailer_car["Height"] for trailer_car in train_data["TrailerCars"]])
-    w_in_max = max([power_unit["Width"] for power_unit in train_data["PowerUnits"]] + \
-        [trailer_car["Width"] for trailer_car in train_data["TrailerCars"]])
+    h_in_max = max([unit["Height"] for unit in units])
+    w_in_max = max([unit["Width"] for unit in units])
     # (sum, power units) traction power and force
     P_hp_tot = sum([power_unit["TractionPower"] for power_unit in train_data["PowerUnits"]])
     F_lbf_tot = sum([power_unit["TractionForce"] for power_unit in train_data["PowerUnits"]])
     # (sum, all units) mass
-    m_lb_total = sum([power_unit["Mass"] for power_unit in train_data["PowerUnits"]] + \
-        [trailer_car["Mass"] for trailer_car in train_data["TrailerCars"]])
-        
+    m_lb_total = sum([unit["Mass"] for unit in units])
+    
     # calculate combined coefficient of drag (D)
     D = calc_D(h_in_max, w_in_max, C_d = C_d)
-        
-    # put it all together to initialize a Train
-    if brake_params_defined:
-        train = Train(m_lb_total, \
-            P_hp_tot, \
-            F_lbf_tot, \
-            brake_a1_mphps=brake_a1_mphps, \
-            brake_a2_mphps=brake_a2_mphps, \
-            brake_v1_mph=brake_v1_mph, \
-            D=D)
-    else:
-        train = Train(m_lb_total, \
-            P_hp_tot, \
-            F_lbf_tot, \
-            D=D)
-    return train
     
-def gen_timetable(train_json, route_csv, t_dwell=120):
+    return {"m_lb": m_lb_total,
+            "P_hp": P_hp_tot,
+            "F_lbf": F_lbf_tot,
+            "brake_a1_mphps": brake_a1_mphps,
+            "brake_a2_mphps": brake_a2_mphps,
+            "brake_v1_mph": brake_v1_mph,
+            "D": D}
+
+def load_train(train_json):
     '''
-    Wrapper: 
-    Initializes a Train to be used for performance calculations (load_train)
-    Loads a .csv file representing a route
-    See sample .csv for format
-    Calculates time required to arrive at each stop from previous stop
-    Calculates avg speed of each segment
-    Generates .csv with two new columns
+    Wrapper:
+    loads a .json file representing a train consist
+    See sample .json for format
+    Extracts, aggregates necessary performance parameters, dimensions (parse_train)
+    Initializes a Train to be used for performance calculations
     '''
+    # load json from path
+    with open(train_json) as j_file:
+        train_data = json.load(j_file)
+    # put it all together to initialize a Train
+    return Train(**parse_train(train_data))
+
+# Train args, in the order stored in compiled fleet files
+TRAIN_PARAMS = ("m_lb", "P_hp", "F_lbf", "brake_a1_mphps", "brake_a2_mphps", "brake_v1_mph", "D")
+
+class ConsistRegistry():
+    def __init__(self, maxsize=256):
+        '''
+        Memoizes train consist .json files: each file is parsed once, and its Train args and
+        Train are kept, keyed on path; an entry is reused while the file's mtime and size are
+        unchanged, or (if they changed) while its content hash is unchanged
+        maxsize (optional) = max number of consists kept, least recently used evicted first
+        '''
+        assert maxsize > 0, \
+            "maxsize must be a positive number!"
+        self.maxsize = maxsize
+        # abs path => {'mtime_ns', 'size', 'digest', 'params', 'train'}, least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
     
-    # initialize Train
-    train = load_train(train_json)
+    def _entry(self, train_json):
+        '''Returns the up-to-date entry for train_json, parsing the file only if its contents changed'''
+        path = os.path.abspath(train_json)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+            self.hits += 1
+        else:
+            with open(path, 'rb') as j_file:
+                contents = j_file.read()
+            digest = hashlib.sha256(contents).hexdigest()
+            if entry is not None and entry['digest'] == digest:
+                # touched, not changed
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry = {'digest': digest, 'params': parse_train(json.loads(contents)), 'train': None}
+            entry['mtime_ns'], entry['size'] = stat.st_mtime_ns, stat.st_size
+            self.entries[path] = entry
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
     
+    def params(self, train_json):
+        '''Returns the Train args (dict, see TRAIN_PARAMS) of a train consist .json file'''
+        return dict(self._entry(train_json)['params'])
+    
+    def get(self, train_json):
+        '''Returns the Train of a train consist .json file, as load_train (shared; built once)'''
+        entry = self._entry(train_json)
+        if entry['train'] is None:
+            entry['train'] = Train(**entry['params'])
+        return entry['train']
+    
+    def load_fleet(self, fleet_npy):
+        '''
+        Seeds the registry from a compiled fleet file (compile_fleet), in a single read:
+        consists whose .json files are unchanged since compiling are not parsed again
+        Returns the list of .json paths in the fleet
+        '''
+        fleet = np.load(fleet_npy)
+        for row in fleet:
+            path = str(row['path'])
+            self.entries[path] = {'mtime_ns': int(row['mtime_ns']),
+                                  'size': int(row['size']),
+                                  'digest': str(row['digest']),
+                                  'params': {param: float(row[param]) for param in TRAIN_PARAMS},
+                                  'train': None}
+            self.entries.move_to_end(path)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return [str(path) for path in fleet['path']]
+
+def compile_fleet(train_jsons, fleet_npy):
+    '''
+    Compiles train consist .json files into one compact fleet file (.npy structured array:
+    one row per consist, with its path, mtime, size, content hash and Train args)
+    Returns the fleet array
+    '''
+    registry = ConsistRegistry(maxsize=max(1, len(train_jsons)))
+    entries = [(os.path.abspath(train_json), registry._entry(train_json)) for train_json in train_jsons]
+    fleet = np.array([(path, entry['mtime_ns'], entry['size'], entry['digest'])
+                      + tuple(entry['params'][param] for param in TRAIN_PARAMS)
+                      for path, entry in entries],
+                     dtype=[('path', f"U{max([len(path) for path, _ in entries] + [1])}"),
+                            ('mtime_ns', 'i8'), ('size', 'i8'), ('digest', 'U64')]
+                           + [(param, 'f8') for param in TRAIN_PARAMS])
+    np.save(fleet_npy, fleet)
+    return fleet
+
+def load_fleet(fleet_npy):
+    '''Returns {train consist .json path: Train} from a compiled fleet file (compile_fleet)'''
+    fleet = np.load(fleet_npy)
+    return {str(row['path']): Train(**{param: float(row[param]) for param in TRAIN_PARAMS}) for row in fleet}
+
+def load_train_batch(train_jsons):
+    '''
+    Wrapper:
+    loads train consist .json files (as load_train) into one TrainBatch, in order
+    '''
+    registry = ConsistRegistry(maxsize=max(1, len(train_jsons)))
+    params = [registry.params(train_json) for train_json in train_jsons]
+    return TrainBatch(**{param: [p[param] for p in params] for param in TRAIN_PARAMS})
+    
+def load_route(route_csv):
+    '''
+    Loads a .csv file representing a route into a dataframe
+    See sample .csv for format
+    Checks the route is well-formed (check_route)
+    '''
     # load csv into dataframe
+    import pandas as pd
     route_df = pd.read_csv(route_csv)
-    
+    check_route(route_df)
+    return route_df
+
+def check_route(route_df, first_row=True):
+    '''
+    Checks a route dataframe is well-formed
+    first_row (optional) = False if route_df is a later chunk of a route,
+    so its first row is not the route's first row
+    '''
     # sanity check: necessary columns present, no missing values
     assert all(['track speed (mph)' in route_df, 'dist (mi)' in route_df]), \
         "Route .csv must contain columns: 'track speed (mph)' and 'dist (mi)'!"
@@ -88,63 +199,593 @@ def gen_timetable(train_json, route_csv, t_dwell=120):
         "Column 'dist (mi)' cannot be missing values!"
     
     # sanity check: cannot have 0 values, except in the first row
-    if 0 in route_df.iloc[1:].values:
+    if 0 in route_df.iloc[1 if first_row else 0:].values:
         raise ValueError("Route .csv cannot contain zeroes except in the first row!")
         
     # sanity check: first row must have zeroes, in both dist and track speed columns, or neither
-    first_row_zero = False
-    if 0 in route_df.iloc[0].values:
+    if first_row and 0 in route_df.iloc[0].values:
         assert all([route_df['track speed (mph)'].iloc[0] == 0, route_df['dist (mi)'].iloc[0] == 0]), \
             "First row 'track speed (mph)' and 'dist (mi)' must both be 0, or neither be 0!"
-        first_row_zero = True
-    
-    # cannot apply stop_to_stop_time or calc_avg_vel, with any 'dist (mi)' or 'track speed (mph)' equal to 0
-    # if first row contains zeroes: save, remove, add back after applying
-    if first_row_zero:
-        first_row = route_df.head(1)
-        route_df.drop(0, inplace=True)
-    
-    # apply train stop_to_stop_time on 'dist (mi)', 'track speed (mph)', to get 'time (min)'
-    # / 60 to get 'time (min)' from secs
-    # apply calc_avg_vel to get 'avg spd (mph)'
-    # / 60 again to use 'time (min)' in hours
-    s2s_lambda = lambda x: train.stop_to_stop_time(x['dist (mi)'], x['track speed (mph)'], t_dwell) / 60
-    route_df['time (min)'] = route_df.apply(s2s_lambda, axis=1)
-    avg_lambda = lambda x: calc_avg_vel(x['dist (mi)'], x['time (min)'] / 60)
-    route_df['avg spd (mph)'] = route_df.apply(avg_lambda, axis=1)
-    
-    # fill zeroes in first row's new columns; add back first row
-    if first_row_zero:
-        first_row.insert(len(first_row.columns), 'time (min)', [0])
-        first_row.insert(len(first_row.columns), 'avg spd (mph)', [0])
-        route_df = first_row.append(route_df, ignore_index=True)
-
-    # generate new timetable csv
-    out_name = route_csv[0:-4] + '_timetable.csv'
-    route_df.to_csv(out_name, index=False)
+
+    # sanity check: speed restrictions (optional) lie within their segments
+    rows, starts, ends, speeds = parse_restrictions(route_df)
+    if len(rows) > 0:
+        assert not (first_row and rows[0] == 0), \
+            "First row cannot have 'restrictions'!"
+        assert all([np.all(starts >= 0), np.all(ends > starts), np.all(speeds > 0)]), \
+            "Restrictions must have 0 <= start < end, and a positive speed!"
+        assert np.all(starts < route_df['dist (mi)'].to_numpy(dtype=float)[rows]), \
+            "Restrictions must start before the segment's arrival stop!"
+
+# route 'restrictions' format: ';'-separated "start-end:speed" (see parse_restrictions)
+_RESTRICTION_NUM = r"\d+(?:\.\d*)?|\.\d+"
+_RESTRICTION = rf"\s*(?:{_RESTRICTION_NUM})\s*-\s*(?:{_RESTRICTION_NUM})\s*:\s*(?:{_RESTRICTION_NUM})\s*"
+_RESTRICTIONS_RE = re.compile(rf"(?:{_RESTRICTION}|\s*)(?:;(?:{_RESTRICTION}|\s*))*")
+
+def parse_restrictions(route_df):
+    '''
+    Parses a route dataframe's optional 'restrictions' column: per stop-to-stop segment, a ';'-separated list of
+    speed restrictions "start-end:speed", in mi from the segment's departure stop and mph, eg. "1.2-1.8:30; 4-4.5:45"
+    Returns arrays (row, start (mi), end (mi), speed (mph)), one entry per restriction, in row order
+    '''
+    if 'restrictions' not in route_df:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0), np.zeros(0)
+    # rows with restrictions (empty cells are NaN), checked against the format one regex match per row
+    entries = [(row, entry) for row, entry in enumerate(route_df['restrictions']) if isinstance(entry, str)]
+    for row, entry in entries:
+        if _RESTRICTIONS_RE.fullmatch(entry) is None:
+            raise ValueError(f"Restrictions '{entry}' in route row {row} must be ';'-separated 'start-end:speed'!")
+    # then every number at once: 3 per restriction, one restriction per ':'
+    values = np.array(re.findall(_RESTRICTION_NUM, ";".join(entry for _, entry in entries)), dtype=float).reshape(-1, 3)
+    rows = np.repeat(np.array([row for row, _ in entries], dtype=int), [entry.count(':') for _, entry in entries])
+    return rows, values[:, 0], values[:, 1], values[:, 2]
+
+def check_unrestricted(route_df, tool):
+    '''Checks a route has no speed restrictions (parse_restrictions), for tools that only model track speed'''
+    assert len(parse_restrictions(route_df)[0]) == 0, \
+        f"{tool} does not support speed restrictions yet: remove the route's 'restrictions', or use timetable.py or sizing.py"
+
+def restricted_sections(dists, speeds, rows, starts, ends, r_speeds):
+    '''
+    Splits restricted segments into sections of constant speed limit, for Train.section_run_times
+    dists, speeds = every route row's 'dist (mi)' and 'track speed (mph)'
+    rows, starts, ends, r_speeds = restrictions (parse_restrictions); ends past the arrival stop are clipped to it
+    Returns (restricted rows, section lengths (mi), section speed limits (mph), sections per restricted row):
+    each row's sections split at every restriction's start and end, limited to the lowest speed covering them
+    '''
+    seg_rows, seg = np.unique(rows, return_inverse=True)
+    seg = seg.ravel()
+    n, n_r = len(seg_rows), len(rows)
+    d_seg = dists[seg_rows]
+    # breakpoints: both stops of every restricted row, and every restriction's start and end; sorted per row
+    bp_run = np.concatenate([np.arange(n), np.arange(n), seg, seg])
+    bp_x = np.concatenate([np.zeros(n), d_seg, starts, np.minimum(ends, d_seg[seg])])
+    order = np.lexsort((bp_x, bp_run))
+    keep = np.concatenate([[True], (np.diff(bp_run[order]) != 0) | (np.diff(bp_x[order]) > 0)])
+    # each breakpoint's index, once duplicates are dropped
+    kept_idx = np.empty(len(order), dtype=int)
+    kept_idx[order] = np.cumsum(keep) - 1
+    bp_run, bp_x = bp_run[order][keep], bp_x[order][keep]
+
+    # sections lie between consecutive breakpoints of a row: section index = breakpoint index - row index
+    sec = np.flatnonzero(bp_run[:-1] == bp_run[1:])
+    sec_run = bp_run[sec]
+    d_sec = bp_x[sec + 1] - bp_x[sec]
+    v_sec = speeds[seg_rows][sec_run].astype(float)
+    # each restriction covers the sections from its start breakpoint up to its end breakpoint
+    first_sec = kept_idx[2 * n:2 * n + n_r] - seg
+    counts = kept_idx[2 * n + n_r:] - seg - first_sec
+    covered = np.repeat(first_sec, counts) + np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    np.minimum.at(v_sec, covered, np.repeat(r_speeds, counts))
+    return seg_rows, d_sec, v_sec, np.bincount(sec_run, minlength=n)
+
+def _mix64(h):
+    '''splitmix64 finalizer: scrambles uint64 h, elementwise'''
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+def segment_keys(train, dists, speeds, t_dwell=120):
+    '''
+    Returns a 64-bit hash of (train params, dwell, dist, track speed) per segment, in one vectorized pass
+    train = Train, or TrainProfile (keyed on its tables, so exact and tabulated results never mix)
+    '''
+    if isinstance(train, TrainProfile):
+        params = ["profile", train.key, t_dwell]
+    else:
+        params = ["exact", train.m, train.P, train.F, train.D, train.brake_a1, train.brake_a2, train.brake_v1, t_dwell]
+    seed = np.uint64(int(hashlib.sha256(repr(params).encode()).hexdigest()[0:16], 16))
+    with np.errstate(over="ignore"):
+        h = _mix64(seed ^ np.asarray(dists, dtype=np.float64).view(np.uint64))
+        return _mix64(h ^ np.asarray(speeds, dtype=np.float64).view(np.uint64))
+
+class SegmentStore():
+    def __init__(self, path=None):
+        '''
+        Per-segment stop-to-stop results, keyed on segment_keys, for incremental timetables:
+        when a route is edited and run again, only segments not already in the store are calculated
+        path (optional) = .npz file to load the store from (if it exists) and save it to
+        '''
+        self.path = path
+        # sorted keys, and each one's stop-to-stop time (s) and avg speed (mph)
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.t = np.zeros(0)
+        self.v_avg = np.zeros(0)
+        if path is not None and os.path.exists(path):
+            with np.load(path) as tables:
+                self.keys, self.t, self.v_avg = tables["keys"], tables["t"], tables["v_avg"]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        '''Returns (found, stop-to-stop time (s), avg speed (mph)) per key; 0 where not found'''
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool), np.zeros(len(keys)), np.zeros(len(keys))
+        idx = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[idx] == keys
+        return found, np.where(found, self.t[idx], 0), np.where(found, self.v_avg[idx], 0)
+
+    def add(self, keys, t, v_avg):
+        '''Adds results for keys (replacing any already stored)'''
+        keys = np.concatenate([keys, self.keys])
+        # np.unique keeps the first of duplicates: the new result
+        self.keys, first = np.unique(keys, return_index=True)
+        self.t = np.concatenate([t, self.t])[first]
+        self.v_avg = np.concatenate([v_avg, self.v_avg])[first]
+
+    def save(self, path=None):
+        '''Saves the store to path (default: the path it was loaded from)'''
+        path = path if path is not None else self.path
+        assert path is not None, \
+            "SegmentStore needs a path to save to!"
+        # write then rename, so an interrupted run never leaves a partial store
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, keys=self.keys, t=self.t, v_avg=self.v_avg)
+        os.replace(tmp_path, path)
+
+def route_segments(route_df):
+    '''
+    Returns (rows, dist (mi), track speed (mph)) of a route's stop-to-stop segments: every row
+    but a first row of zeroes (on loop routes, the first row is a segment too, from the last stop)
+    '''
+    dists = route_df['dist (mi)'].to_numpy(dtype=float)
+    speeds = route_df['track speed (mph)'].to_numpy(dtype=float)
+    rows = np.flatnonzero((dists != 0) & (speeds != 0))
+    return rows, dists[rows], speeds[rows]
+
+def segment_stops(route_df):
+    '''
+    Returns the stops at the ends of a route's segments (route_segments), in order: the first segment's
+    departure stop (on loop routes, the last stop), then every segment's arrival stop
+    (stop names, or row numbers if the route has no 'arrival stop' column)
+    '''
+    rows = route_segments(route_df)[0]
+    stops = route_df['arrival stop'].to_numpy() if 'arrival stop' in route_df else np.arange(len(route_df))
+    origin = stops[-1] if len(rows) > 0 and rows[0] == 0 else stops[0]
+    return np.concatenate([[origin], stops[rows]])
+
+def calc_timetable(train, route_df, t_dwell=120, store=None):
+    '''
+    Calculates time required to arrive at each stop from previous stop
+    Calculates avg speed of each segment
+    train = Train (or TrainProfile) to run
+    route_df = route dataframe (load_route)
+    store (optional) = SegmentStore: segments already in it are not calculated again,
+    and newly calculated ones are added to it
+    Segments with speed restrictions (parse_restrictions) are run through their sections,
+    all in one batch (Train.section_run_times; exact, even if train is a TrainProfile)
+    Returns route_df with two new columns, all segments calculated in one batch
+    '''
+    route_df = route_df.copy()
+    dists = route_df['dist (mi)'].to_numpy(dtype=float)
+    speeds = route_df['track speed (mph)'].to_numpy(dtype=float)
+    
+    # cannot calculate stop_to_stop_time or avg speed with 'dist (mi)' or 'track speed (mph)' equal to 0
+    # (only allowed in the first row): leave zeroes in those rows' new columns
+    moving = np.zeros(len(route_df), dtype=bool)
+    moving[route_segments(route_df)[0]] = True
+    rows, starts, ends, r_speeds = parse_restrictions(route_df)
+    plain = moving.copy()
+    plain[rows] = False
+    times = np.zeros(len(route_df))
+    avg_spds = np.zeros(len(route_df))
+    if np.any(plain):
+        if store is None:
+            t_s2s, v_peak, v_avg = train.stop_to_stop_times(dists[plain], speeds[plain], t_dwell)
+        else:
+            t_s2s, v_avg = _calc_segments_stored(train, dists[plain], speeds[plain], t_dwell, store)
+        assert np.all(t_s2s > 0), \
+            "Travel time cannot be calculated for every segment! Check 'track speed (mph)' against the train's params!"
+        # / 60 to get 'time (min)' from secs
+        times[plain] = t_s2s / 60
+        avg_spds[plain] = v_avg
+    if len(rows) > 0:
+        seg_rows, d_sec, v_sec, run_len = restricted_sections(dists, speeds, rows, starts, ends, r_speeds)
+        exact = train.train if isinstance(train, TrainProfile) else train
+        t_run = exact.section_run_times(d_sec, v_sec, run_len, t_dwell)
+        assert np.all(t_run > 0), \
+            "Travel time cannot be calculated for every restricted segment! Check restriction speeds against the train's params!"
+        times[seg_rows] = t_run / 60
+        avg_spds[seg_rows] = dists[seg_rows] / (t_run / 3600)
+    
+    route_df['time (min)'] = times
+    route_df['avg spd (mph)'] = avg_spds
+    return route_df
+
+def _calc_segments_stored(train, dists, speeds, t_dwell, store):
+    '''Returns (stop-to-stop time (s), avg speed (mph)) per segment, calculating only the distinct segments not in store'''
+    keys = segment_keys(train, dists, speeds, t_dwell)
+    found, t_s2s, v_avg = store.lookup(keys)
+    if not np.all(found):
+        new_keys, first, inverse = np.unique(keys[~found], return_index=True, return_inverse=True)
+        stale = np.flatnonzero(~found)[first]
+        t_new, _, v_new = train.stop_to_stop_times(dists[stale], speeds[stale], t_dwell)
+        t_new, v_new = np.atleast_1d(t_new), np.atleast_1d(v_new)
+        t_s2s[~found], v_avg[~found] = t_new[inverse.ravel()], v_new[inverse.ravel()]
+        # failed segments (-1) are not stored
+        ok = t_new > 0
+        store.add(new_keys[ok], t_new[ok], v_new[ok])
+    logger.info(f"{len(keys) - int(np.sum(found))} of {len(keys)} segments calculated, the rest from the segment store")
+    return t_s2s, v_avg
+    
+# output table formats, by file extension
+OUT_FORMATS = {".csv": "csv", ".parquet": "parquet", ".feather": "feather", ".npz": "npz", ".npy": "npy"}
+OUT_EXTS = {fmt: ext for ext, fmt in OUT_FORMATS.items()}
+
+def _out_format(out_path, fmt=None):
+    '''Returns fmt, or the output format of out_path's extension (default: csv)'''
+    if fmt is None:
+        fmt = OUT_FORMATS.get(os.path.splitext(out_path)[1].lower(), "csv")
+    assert fmt in OUT_EXTS, \
+        f"Output format must be one of: {', '.join(OUT_EXTS)}"
+    return fmt
+
+def _require_pyarrow(fmt):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError(f"{fmt} files need pyarrow (pip install pyarrow); use npz or npy instead") from None
+
+def _column_array(column):
+    '''Returns a dataframe column as a fixed-width array (strings as unicode), so it can be memory-mapped'''
+    values = column.to_numpy()
+    return values.astype(str) if values.dtype == object else values
+
+def write_table(df, out_path, fmt=None, meta=None):
+    '''
+    Writes a dataframe (eg. a timetable or sweep summary) to out_path, as fmt (default: by out_path's extension):
+      csv
+      parquet, feather = columnar, need pyarrow; feather is written uncompressed, so it can be memory-mapped
+      npz = one uncompressed array per column; npy = one structured array, one field per column
+    npz and npy get a .json metadata sidecar at <out_path>.json: format, rows, columns and their dtypes,
+    and meta (optional dict, eg. the train and route); load_columns memory-maps them, zero-copy
+    Returns out_path
+    '''
+    fmt = _out_format(out_path, fmt)
+    if fmt == "csv":
+        df.to_csv(out_path, index=False)
+        return out_path
+    if fmt in ("parquet", "feather"):
+        _require_pyarrow(fmt)
+        df = df.reset_index(drop=True)
+        if fmt == "parquet":
+            df.to_parquet(out_path, index=False)
+        else:
+            df.to_feather(out_path, compression="uncompressed")
+        return out_path
+
+    columns = {str(name): _column_array(df[name]) for name in df.columns}
+    with open(out_path, "wb") as f:
+        if fmt == "npz":
+            np.savez(f, **columns)
+        else:
+            records = np.empty(len(df), dtype=[(name, values.dtype) for name, values in columns.items()])
+            for name, values in columns.items():
+                records[name] = values
+            np.save(f, records)
+    with open(out_path + ".json", "w") as j_file:
+        json.dump({"format": fmt,
+                   "rows": len(df),
+                   "columns": [{"name": name, "dtype": values.dtype.str} for name, values in columns.items()],
+                   **(meta or {})}, j_file, indent=2)
+    return out_path
+
+def load_columns(path, fmt=None):
+    '''
+    Loads a table written by write_table as {column: array}, in column order
+    npz, npy and feather columns are memory-mapped (read-only, zero-copy where the dtype allows);
+    parquet and csv are read into memory
+    '''
+    fmt = _out_format(path, fmt)
+    if fmt == "npz":
+        arrays = _load_npz_mmap(path)
+        if os.path.exists(path + ".json"):
+            with open(path + ".json") as j_file:
+                return {column["name"]: arrays[column["name"]] for column in json.load(j_file)["columns"]}
+        return arrays
+    if fmt == "npy":
+        records = np.load(path, mmap_mode="r")
+        return {name: records[name] for name in records.dtype.names}
+    if fmt in ("parquet", "feather"):
+        _require_pyarrow(fmt)
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            table = pq.read_table(path)
+        else:
+            import pyarrow.feather as pf
+            table = pf.read_table(path, memory_map=True)
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+    import pandas as pd
+    df = pd.read_csv(path)
+    return {name: df[name].to_numpy() for name in df.columns}
+
+def gen_timetable(train_json, route_csv, t_dwell=120, cache_dir=None, out_path=None, out_format=None, store_path=None):
+    '''
+    Wrapper: 
+    Initializes a Train to be used for performance calculations (load_train)
+    If cache_dir is given, answers stop-to-stop times from the Train's TrainProfile,
+    loaded from (or saved to) cache_dir
+    Loads a .csv file representing a route (load_route)
+    See sample .csv for format
+    Calculates time required to arrive at each stop from previous stop
+    Calculates avg speed of each segment (calc_timetable)
+    Writes the route with two new columns (write_table) to out_path
+    (default: <route_csv>_timetable.csv, or the extension of out_format)
+    out_format (optional) = csv, parquet, feather, npz or npy (default: by out_path's extension)
+    store_path (optional) = SegmentStore .npz file: after editing the route, only its changed
+    segments are calculated again; the store is updated with them
+    Returns out_path
+    '''
+    
+    # initialize Train
+    train = load_train(train_json)
+    if cache_dir is not None:
+        train = TrainProfile(train, cache_dir=cache_dir)
+    
+    store = SegmentStore(store_path) if store_path is not None else None
+    route_df = calc_timetable(train, load_route(route_csv), t_dwell, store)
+    if store is not None:
+        store.save()
+
+    # write the new timetable
+    if out_path is None:
+        out_path = route_csv[0:-4] + '_timetable' + OUT_EXTS[_out_format('', out_format)]
+    return write_table(route_df, out_path, out_format, meta={'train': train_json, 'route': route_csv, 'dwell (s)': t_dwell})
+    
+def gen_timetable_stream(train_json, route_csv, out_csv, t_dwell=120, cache_dir=None, chunksize=100000, store_path=None):
+    '''
+    Wrapper:
+    As gen_timetable, but streams the route through in chunks of chunksize rows,
+    writing each chunk's timetable rows as soon as they are calculated,
+    so memory use does not grow with the route's length
+    route_csv = route .csv path, or '-' to read from stdin
+    out_csv = timetable .csv path, or '-' to write to stdout
+    store_path (optional) = as gen_timetable
+    '''
+    
+    import pandas as pd
+    # initialize Train
+    train = load_train(train_json)
+    if cache_dir is not None:
+        train = TrainProfile(train, cache_dir=cache_dir)
+    
+    store = SegmentStore(store_path) if store_path is not None else None
+    in_file = sys.stdin if route_csv == '-' else route_csv
+    out_file = sys.stdout if out_csv == '-' else open(out_csv, 'w', newline='')
+    try:
+        # running state across chunks: only whether this is the route's first chunk
+        first_chunk = True
+        for chunk_df in pd.read_csv(in_file, chunksize=chunksize):
+            check_route(chunk_df, first_row=first_chunk)
+            calc_timetable(train, chunk_df, t_dwell, store).to_csv(out_file, header=first_chunk, index=False)
+            out_file.flush()
+            first_chunk = False
+        if store is not None:
+            store.save()
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+    
+def expand_paths(patterns, ext):
+    '''
+    Expands a list of globs, directories and/or file paths
+    into a sorted list of unique files ending in ext (eg. ".json")
+    '''
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*" + ext)
+        paths.update(path for path in glob.glob(pattern) if path.endswith(ext))
+    return sorted(paths)
+
+# per-worker-process consists and speed-profile tables, so each consist is built once per worker
+_sweep_registry = ConsistRegistry()
+_sweep_profiles = {}
+_sweep_fleets = set()
+
+def _sweep_pair(train_json, route_csv, t_dwell, out_path, cache_dir, collect_stats, fleet_npy=None, memo=False, out_format=None):
+    '''
+    Sweep worker:
+    Generates the timetable of one (train, route) pair into out_path (write_table, as out_format)
+    fleet_npy (optional) = compiled fleet file to seed the worker's consist registry from
+    memo (optional) = if True (and no cache_dir), memoizes each consist's stop-to-stop times across routes
+    Returns a summary row (dict) for the pair, and its instrumentation counters if collect_stats
+    '''
+    summary = {'train': train_json, 'route': route_csv, 'timetable': out_path}
+    if collect_stats:
+        enable_stats()
+    try:
+        if fleet_npy is not None and fleet_npy not in _sweep_fleets:
+            _sweep_registry.load_fleet(fleet_npy)
+            _sweep_fleets.add(fleet_npy)
+        train = _sweep_registry.get(train_json)
+        if memo and cache_dir is None and train.memo is None:
+            train.enable_memo()
+        if cache_dir is not None:
+            if train not in _sweep_profiles:
+                _sweep_profiles[train] = TrainProfile(train, cache_dir=cache_dir)
+            train = _sweep_profiles[train]
+        route_df = calc_timetable(train, load_route(route_csv), t_dwell)
+        write_table(route_df, out_path, out_format, meta={'train': train_json, 'route': route_csv, 'dwell (s)': t_dwell})
+    except (AssertionError, ValueError, KeyError, OSError) as e:
+        summary['error'] = f"{type(e).__name__}: {e}"
+    else:
+        summary['stops'] = len(route_df)
+        summary['dist (mi)'] = route_df['dist (mi)'].sum()
+        summary['time (min)'] = route_df['time (min)'].sum()
+        summary['avg spd (mph)'] = summary['dist (mi)'] / (summary['time (min)'] / 60)
+    return summary, (STATS.to_dict() if collect_stats else None)
+
+def sweep_timetables(train_jsons, route_csvs, out_dir, t_dwell=120, workers=None, cache_dir=None, collect_stats=False, fleet_npy=None,
+                     memo=False, out_format="csv"):
+    '''
+    Wrapper:
+    Generates a timetable for every (train, route) pair, fanned out across a process pool
+    train_jsons = list of train consist .json files
+    route_csvs = list of route .csv files
+    out_dir = directory to write one timetable per pair, and the summary, to
+    workers (optional) = number of worker processes (default: one per CPU)
+    cache_dir (optional) = as gen_timetable
+    collect_stats (optional) = if True, adds every worker's instrumentation counters into STATS
+    fleet_npy (optional) = compiled fleet file (compile_fleet) of the train consists, so workers skip parsing them
+    memo (optional) = if True (and no cache_dir), workers memoize stop-to-stop times (Train.enable_memo), so segments
+    repeated across routes are calculated once per worker
+    out_format (optional) = format of the timetables and summary (write_table): csv, parquet, feather, npz or npy
+    Returns the summary dataframe: one row per pair, with totals (or the error, if it failed)
+    '''
+    ext = OUT_EXTS[_out_format('', out_format)]
+    if out_format in ("parquet", "feather"):
+        # fail once here, not in every worker
+        _require_pyarrow(out_format)
+    os.makedirs(out_dir, exist_ok=True)
+    pairs = []
+    for train_json in train_jsons:
+        for route_csv in route_csvs:
+            train_name = os.path.splitext(os.path.basename(train_json))[0]
+            route_name = os.path.splitext(os.path.basename(route_csv))[0]
+            out_path = os.path.join(out_dir, f"{route_name}__{train_name}_timetable{ext}")
+            pairs.append((train_json, route_csv, t_dwell, out_path, cache_dir, collect_stats, fleet_npy, memo, out_format))
+
+    # pairs are ordered train-major, so chunks sent to one worker mostly share a consist
+    chunksize = max(1, len(pairs) // (4 * (workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_sweep_pair, *zip(*pairs), chunksize=chunksize))
+
+    summaries = []
+    for summary, stats_dict in results:
+        summaries.append(summary)
+        if stats_dict is not None:
+            STATS.merge(stats_dict)
+    import pandas as pd
+    summary_df = pd.DataFrame(summaries)
+    write_table(summary_df, os.path.join(out_dir, 'summary' + ext), out_format)
+    return summary_df
     
 if __name__ == "__main__":
     '''
     Command line interface
     Calculates timetable from train consist .json file, and route .csv file
     Sample usage: timetable.py -t sample_train_A.json -r sample_route_A.csv -d 120
+    Or, sweep mode: calculates timetables for every train x route pair
+    Sample usage: timetable.py -T trains/ "more_trains/*.json" -R "routes/*.csv" -w 8 -o sweep
+    Or, compile a fleet of train consists into one file, to speed up sweeps over it
+    Sample usage: timetable.py -T trains/ -F fleet.npy --compilefleet
     '''
     
     parser = argparse.ArgumentParser()
-    parser.add_argument("-t", "--trainfile", required=True, help=".json file representing a train consist")
-    parser.add_argument("-r", "--routefile", required=True, help=".csv file representing a route")
+    parser.add_argument("-t", "--trainfile", required=False, help=".json file representing a train consist")
+    parser.add_argument("-r", "--routefile", required=False, help=".csv file representing a route")
     parser.add_argument("-d", "--dwelltime", required=False, default=120, type=float, help="(optional) dwell/buffer time at each stop in seconds")
+    parser.add_argument("-c", "--cachedir", required=False, default=".trainprofiles", help="(optional) directory to cache precomputed train speed-profile tables in")
+    parser.add_argument("--exact", action="store_true", help="(optional) compute every stop-to-stop time exactly, instead of from cached speed-profile tables")
+    parser.add_argument("-T", "--trainfiles", required=False, nargs="+", help="(sweep mode) globs or directories of train consist .json files")
+    parser.add_argument("-R", "--routefiles", required=False, nargs="+", help="(sweep mode) globs or directories of route .csv files")
+    parser.add_argument("-w", "--workers", required=False, default=None, type=int, help="(sweep mode, optional) number of worker processes, default one per CPU")
+    parser.add_argument("-F", "--fleetfile", required=False, default=None, help="(sweep mode, optional) compiled fleet .npy file; with --compilefleet, written from --trainfiles, otherwise read to skip parsing unchanged consists")
+    parser.add_argument("--compilefleet", action="store_true", help="(optional) only compile --trainfiles into --fleetfile")
+    parser.add_argument("--memo", action="store_true", help="(sweep mode, with --exact, optional) memoize stop-to-stop times, so segments repeated across routes are calculated once")
+    parser.add_argument("-o", "--outdir", required=False, default="sweep", help="(sweep mode, optional) directory to write timetables and summary.csv to")
+    parser.add_argument("-O", "--outfile", required=False, default=None, help="(optional) timetable path, or '-' for stdout (default: <routefile>_timetable.csv, or the extension of --format)")
+    parser.add_argument("-f", "--format", required=False, default=None, choices=list(OUT_EXTS), help="(optional) timetable (and sweep summary) format, default by --outfile's extension, else csv; parquet and feather need pyarrow, npz and npy get a .json metadata sidecar")
+    parser.add_argument("-i", "--incremental", required=False, default=None, help="(optional) segment store .npz file: only route segments not already in it are calculated, and it is updated with them")
+    parser.add_argument("--stream", action="store_true", help="(optional) read the route and write the timetable in chunks, in constant memory; --routefile may be '-' for stdin")
+    parser.add_argument("--chunksize", required=False, default=100000, type=int, help="(--stream, optional) number of route rows per chunk")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="(optional) log train details (-v), and every stop-to-stop calculation (-vv)")
+    parser.add_argument("-s", "--stats", required=False, default=None, help="(optional) .json file to write call counts, wall times and solver iterations to")
     args = parser.parse_args()
     
-    assert all([isinstance(args.trainfile, str), ".json" in args.trainfile]), \
-        "--trainfile must be a path to file in .json format!"
-    assert all([isinstance(args.routefile, str), ".csv" in args.routefile]), \
-        "--routefile must be a path to file in .csv format!"
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
+    logging.getLogger("CTrain").setLevel([logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+    logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    if args.stats is not None:
+        enable_stats()
+    
     assert all([args.dwelltime >= 0]), \
         "--dwelltime must be a nonnegative number!"
+    cache_dir = None if args.exact else args.cachedir
+    
+    if args.compilefleet:
+        assert all([args.trainfiles, args.fleetfile]), \
+            "--compilefleet needs both --trainfiles and --fleetfile!"
+        train_jsons = expand_paths(args.trainfiles, ".json")
+        assert train_jsons, \
+            "--trainfiles must match at least one file!"
+        compile_fleet(train_jsons, args.fleetfile)
+        print(f"Compiled {len(train_jsons)} train consists into {args.fleetfile}")
+    elif args.trainfiles or args.routefiles:
+        assert all([args.trainfiles, args.routefiles]), \
+            "Sweep mode needs both --trainfiles and --routefiles!"
+        assert args.workers is None or args.workers > 0, \
+            "--workers must be a positive number!"
+        train_jsons = expand_paths(args.trainfiles, ".json")
+        route_csvs = expand_paths(args.routefiles, ".csv")
+        assert all([train_jsons, route_csvs]), \
+            "--trainfiles and --routefiles must each match at least one file!"
         
-    print(f"Generating timetable .csv from {args.trainfile} and {args.routefile}...")
-    print("-"*75)
-    gen_timetable(args.trainfile, args.routefile, args.dwelltime)
-    print("Done")
-    time.sleep(5)
\ No newline at end of file
+        print(f"Generating {len(train_jsons) * len(route_csvs)} timetable {args.format or 'csv'} files from {len(train_jsons)} trains and {len(route_csvs)} routes...")
+        print("-"*75)
+        summary_df = sweep_timetables(train_jsons, route_csvs, args.outdir, args.dwelltime, args.workers, cache_dir,
+                                      collect_stats=args.stats is not None, fleet_npy=args.fleetfile, memo=args.memo,
+                                      out_format=args.format or "csv")
+        if 'error' in summary_df:
+            print(f"{summary_df['error'].notnull().sum()} pair(s) failed, see the summary in {args.outdir}")
+        print("Done")
+        if args.stats is not None:
+            STATS.to_json(args.stats)
+    elif args.stream:
+        assert all([isinstance(args.trainfile, str), ".json" in args.trainfile]), \
+            "--trainfile must be a path to file in .json format!"
+        assert all([isinstance(args.routefile, str), args.routefile == "-" or ".csv" in args.routefile]), \
+            "--routefile must be a path to file in .csv format, or '-' for stdin!"
+        assert args.chunksize > 0, \
+            "--chunksize must be a positive number!"
+        assert args.format in (None, "csv"), \
+            "--stream only writes csv!"
+        out_csv = args.outfile if args.outfile is not None else ("-" if args.routefile == "-" else args.routefile[0:-4] + '_timetable.csv')
+        
+        # keep stdout clean for the timetable, if it is written there
+        msg_file = sys.stderr if out_csv == "-" else sys.stdout
+        print(f"Streaming timetable .csv from {args.trainfile} and {args.routefile}...", file=msg_file)
+        try:
+            gen_timetable_stream(args.trainfile, args.routefile, out_csv, args.dwelltime, cache_dir, args.chunksize, args.incremental)
+        except BrokenPipeError:
+            # downstream reader closed early (eg. head); not an error
+            sys.stdout = None
+        else:
+            print("Done", file=msg_file)
+        if args.stats is not None:
+            STATS.to_json(args.stats)
+    else:
+        assert all([isinstance(args.trainfile, str), ".json" in args.trainfile]), \
+            "--trainfile must be a path to file in .json format!"
+        assert all([isinstance(args.routefile, str), ".csv" in args.routefile]), \
+            "--routefile must be a path to file in .csv format!"
+            
+        print(f"Generating timetable from {args.trainfile} and {args.routefile}...")
+        print("-"*75)
+        out_path = gen_timetable(args.trainfile, args.routefile, args.dwelltime, cache_dir, args.outfile, args.format, args.incremental)
+        print(f"Done: {out_path}")
+        if args.stats is not None:
+            STATS.to_json(args.stats)
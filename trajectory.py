@@ -0,0 +1,152 @@
+from CTrain import *
+from CTrain import _scalar_or_array
+from timetable import *
+import argparse
+
+### trajectory phase kinds, in the order each stop-to-stop segment runs through them ###
+DWELL, ACCEL, CRUISE, BRAKE = 0, 1, 2, 3
+
+class Trajectory():
+    def __init__(self, train, route_df, t_dwell=120):
+        '''
+        Position and speed over time of a Train's run along a route, stopping at every stop
+        train = Train, or TrainProfile (whose tables are used for the accel curve either way)
+        route_df = route dataframe (load_route)
+        t_dwell (optional) = dwell/buffer time at each stop, before departing (s)
+
+        Time 0 is arrival at the first stop (stops[0]), and positions are mileposts (mi) from it;
+        each segment runs through four phases (dwell, accel, cruise, brake), stored in time order:
+          phase = phase kind (DWELL, ACCEL, CRUISE, BRAKE); segment = route row the phase arrives at
+          t_start, duration (s); x_start, length (m); v_peak (m/s) of the phase's segment
+        Queries binary search the phases, then evaluate the phase's closed-form or tabulated curve;
+        no stop-to-stop calculation is run again
+        '''
+        # phases are per segment, at its track speed
+        check_unrestricted(route_df, "Trajectory")
+        self.profile = train if isinstance(train, TrainProfile) else TrainProfile(train)
+        self.train = self.profile.train
+        # segments, as calc_timetable: on loop routes, the first row is a segment too, from the last stop
+        rows, d_mi, v_max_mph = route_segments(route_df)
+        self.stops = segment_stops(route_df)
+        n = len(d_mi)
+        assert n > 0, \
+            "Route must have at least two stops!"
+
+        t_total, v_peak_mph, _, info = train.stop_to_stop_times(d_mi, v_max_mph, t_dwell, diagnostics=True)
+        assert np.all(np.asarray(t_total) > 0), \
+            "Stop-to-stop time calculation failed: check train params and route speeds!"
+
+        self.phase = np.tile([DWELL, ACCEL, CRUISE, BRAKE], n)
+        self.segment = np.repeat(rows, 4)
+        self.duration = np.column_stack([np.full(n, float(t_dwell)), info["t_acc"], info["t_vmax"], info["t_brake"]]).ravel()
+        self.length = np.column_stack([np.zeros(n), info["d_acc"], info["d_vmax"], info["d_brake"]]).ravel()
+        self.t_start = np.concatenate([[0], np.cumsum(self.duration)[:-1]])
+        self.x_start = np.concatenate([[0], np.cumsum(self.length)[:-1]])
+        self.v_peak = np.repeat(np.asarray(v_peak_mph) * MPH_TO_M_S, 4)
+
+        # arrival time (s) and milepost (mi) of every stop, the first included
+        self.t_arrival = np.concatenate([[0], (self.t_start + self.duration)[self.phase == BRAKE]])
+        self.x_stop_mi = np.concatenate([[0], np.cumsum(d_mi)])
+        # phases that move, for reverse lookups
+        self._moving = np.flatnonzero(self.length > 0)
+
+    @property
+    def t_total(self):
+        '''Returns the arrival time (s) at the last stop'''
+        return self.t_arrival[-1]
+
+    def _brake_vel_time(self, r):
+        '''Returns the v (m/s) from which braking to a stop takes r (s), elementwise (inverts equation 2.1.1)'''
+        train = self.train
+        t_v1 = train.brake_v1 / train.brake_a1
+        return np.where(r < t_v1, train.brake_a1 * r, train.brake_v1 + train.brake_a2 * (r - t_v1))
+
+    def state_at(self, t):
+        '''
+        Returns (milepost (mi), speed (mph)) at time t (s); before 0 or after the last arrival,
+        the train is at the first or last stop
+        t may be a scalar or an array; returns milepost and speed in the same shape
+        '''
+        t = np.asarray(t, dtype=float)
+        k = np.clip(np.searchsorted(self.t_start, t, side='right') - 1, 0, len(self.t_start) - 1)
+        phase = self.phase[k]
+        tau = np.clip(t - self.t_start[k], 0, self.duration[k])
+        v_peak = self.v_peak[k]
+
+        # accel: speed and distance from the tabulated accel curve, from a stop
+        v_acc = np.minimum(np.interp(tau, self.profile.t_acc, self.profile.v), v_peak)
+        x_acc = np.minimum(np.interp(v_acc, self.profile.v, self.profile.d_acc), self.length[k])
+        # brake: speed and remaining distance from the time left to stop
+        v_brake = np.minimum(self._brake_vel_time(self.duration[k] - tau), v_peak)
+        x_brake = self.length[k] - np.asarray(self.train.calc_brake_dist(v_brake / MPH_TO_M_S))
+
+        v = np.select([phase == ACCEL, phase == CRUISE, phase == BRAKE], [v_acc, v_peak, v_brake], 0)
+        x = self.x_start[k] + np.select([phase == ACCEL, phase == CRUISE, phase == BRAKE],
+                                        [x_acc, v_peak * tau, np.maximum(x_brake, 0)], 0)
+        return _scalar_or_array(x / MI_TO_M), _scalar_or_array(v / MPH_TO_M_S)
+
+    def position_at(self, t):
+        '''Returns the milepost (mi) at time t (s), as state_at'''
+        return self.state_at(t)[0]
+
+    def speed_at(self, t):
+        '''Returns the speed (mph) at time t (s), as state_at'''
+        return self.state_at(t)[1]
+
+    def time_at(self, x_mi):
+        '''
+        Returns the time (s) the train reaches milepost x_mi (at a stop, its arrival time);
+        mileposts are clamped to the route
+        x_mi may be a scalar or an array; returns time in the same shape
+        '''
+        x = np.clip(np.asarray(x_mi, dtype=float) * MI_TO_M, 0, self.x_start[-1] + self.length[-1])
+        moving = self._moving
+        # first moving phase ending at (or, within roundoff, just short of) x
+        k = moving[np.minimum(np.searchsorted((self.x_start + self.length)[moving], x - 1e-6, side='left'), len(moving) - 1)]
+        phase = self.phase[k]
+        dx = np.clip(x - self.x_start[k], 0, self.length[k])
+        v_peak = self.v_peak[k]
+
+        # accel: invert the tabulated accel curve, distance => speed => time
+        tau_acc = np.interp(np.interp(dx, self.profile.d_acc, self.profile.v), self.profile.v, self.profile.t_acc)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tau_cruise = dx / v_peak
+        # brake: time left to stop from the remaining distance
+        v_brake = self.train._calc_brake_vel_dist(self.length[k] - dx)
+        tau_brake = self.duration[k] - np.asarray(self.train.calc_brake_time(v_brake / MPH_TO_M_S))
+
+        tau = np.select([phase == ACCEL, phase == CRUISE, phase == BRAKE], [tau_acc, tau_cruise, tau_brake], 0)
+        t = self.t_start[k] + np.clip(tau, 0, self.duration[k])
+        return _scalar_or_array(np.where(x > 0, t, 0))
+
+    def sample(self, step=10):
+        '''Returns a dataframe of 'time (s)', 'milepost (mi)', 'speed (mph)' every step (s), through the last arrival'''
+        import pandas as pd
+        assert step > 0, \
+            "step must be a positive number!"
+        t = np.append(np.arange(0, self.t_total, step), self.t_total)
+        x_mi, v_mph = self.state_at(t)
+        return pd.DataFrame({'time (s)': t, 'milepost (mi)': x_mi, 'speed (mph)': v_mph})
+
+if __name__ == "__main__":
+    '''
+    Command line interface
+    Samples a train's position and speed along a route over time
+    Sample usage: trajectory.py -t sample_train_A.json -r sample_route_A.csv -S 10
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--trainfile", required=True, help=".json file representing a train consist")
+    parser.add_argument("-r", "--routefile", required=True, help=".csv file representing a route")
+    parser.add_argument("-d", "--dwelltime", required=False, default=120, type=float, help="(optional) dwell/buffer time at each stop in seconds")
+    parser.add_argument("-S", "--step", required=False, default=10, type=float, help="(optional) sampling interval in seconds")
+    parser.add_argument("-O", "--outfile", required=False, default=None, help="(optional) output .csv path (default: <routefile>_trajectory.csv)")
+    args = parser.parse_args()
+
+    assert args.dwelltime >= 0, \
+        "--dwelltime must be a nonnegative number!"
+
+    trajectory = Trajectory(load_train(args.trainfile), load_route(args.routefile), args.dwelltime)
+    out_csv = args.outfile if args.outfile is not None else args.routefile[0:-4] + '_trajectory.csv'
+    trajectory.sample(args.step).to_csv(out_csv, index=False)
+    print(f"{len(trajectory.stops)} stops, {t_round_str(trajectory.t_total)}; trajectory written to {out_csv}")